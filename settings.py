@@ -25,6 +25,74 @@ CONTACT_INDEX_REFRESH = 300
 # number of serach results to be displayed on one page
 RESULT_SIZE = 8
 
+# number of datasets handled in one batch by the index maintenance handlers
+INDEX_BATCH_SIZE = 100
+
+# time (in seconds) the current index generation is cached. A rebuild waits
+# this long before writing and before old generations are deleted.
+INDEX_GENERATION_CACHE_TIME = 60
+
+# max. number of index entries read for one search term
+LOOKUP_MAX_EXPANSION = 1000
+# up to this number of candidates the other search terms are checked
+# with one keys only query per candidate
+LOOKUP_PROBE_LIMIT = 10
+# time (in seconds) search results are cached
+LOOKUP_CACHE_TIME = 60*60
+
+# store trigrams in the search index for typo tolerant search
+TRIGRAM_INDEX = True
+# max. number of index entries read for one trigram
+FUZZY_GRAM_LIMIT = 100
+# max. number of index entries compared with a search term
+FUZZY_MAX_CANDIDATES = 50
+# min. similarity (0.0..1.0) of a keyword with a search term
+FUZZY_THRESHOLD = 0.4
+
+# shortest fragment of a phone number which can be searched (phone:...)
+PHONE_FRAGMENT_LENGTH = 3
+
+# update the search index after a save in the background (see IndexWorker).
+# Set to False to update it before the save returns (e.g. for tests)
+INDEX_WRITE_BEHIND = True
+# time (in seconds) the background index updates are collected
+INDEX_WORKER_INTERVAL = 5
+# time (in seconds) a worker has to process the leased index updates
+INDEX_LEASE_TIME = 60
+# number of attempts after which a queued index update is dropped
+INDEX_MAX_RETRIES = 5
+
+# max. number of change log entries read at once
+CHANGES_BATCH_SIZE = 100
+# changes of the last seconds are left for the next /sync (queries
+# may not see them yet)
+SYNC_SAFETY_MARGIN = 10
+
+# number of contacts read at once by /export
+EXPORT_BATCH_SIZE = 50
+# time (in seconds) after which /export ends a part (see X-Take2-Continue)
+EXPORT_TIME_LIMIT = 20
+# number of key ranges which the background export writes in parallel
+EXPORT_SHARDS = 8
+# size (in characters) of the pieces an import file is stored in
+IMPORT_CHUNK_SIZE = 200*1024
+# number of contacts imported by one task
+IMPORT_BATCH_SIZE = 100
+# time (in seconds) after which an unfinished import job counts as failed
+IMPORT_TIMEOUT = 2*60*60
+# number of shards of a counter which is updated by parallel tasks
+COUNTER_SHARDS = 10
+
+# number of key ranges per table which /fix checks in parallel
+FIX_SHARDS = 8
+# max. number of broken datasets listed in a /fix report shard
+FIX_MAX_FINDINGS = 100
+
+# time (in seconds) autocompletion keywords are cached in memcache
+AUTOCOMPLETE_CACHE_TIME = 60*60
+# time (in seconds) browsers may reuse autocompletion results
+AUTOCOMPLETE_MAX_AGE = 60
+
 COUNTRIES = [{"US":"United States"},
 {"CA":"Canada"},
 {"AF":"Afghanistan"},
@@ -90,6 +90,17 @@ function t2map_contact_reply() {
                     names = names+"<p><small>"+properties['place']+"</small></p>";
                     names = names+"</div>";
                 }
+                // links to the neighbouring pages of the search result
+                if ('previous' in feature_collection || 'next' in feature_collection) {
+                    names = names+"<p class=\"result_pages\">";
+                    if ('previous' in feature_collection) {
+                        names = names+"<a href=\"javascript:void(0)\" onClick=\"t2map_page_req('"+feature_collection['previous']+"')\">&lt; previous</a> ";
+                    }
+                    if ('next' in feature_collection) {
+                        names = names+"<a href=\"javascript:void(0)\" onClick=\"t2map_page_req('"+feature_collection['next']+"')\">next &gt;</a>";
+                    }
+                    names = names+"</p>";
+                }
                 // store list of names in a cookie
                 setCookie("results", names, 300);
                 document.getElementById('results').innerHTML = names;
@@ -122,6 +133,14 @@ function t2map_contact_req() {
     georequest.send(null);
 }
 
+// looks up another page of the last search result (page is a token sent by the server)
+function t2map_page_req(page) {
+    var url = "/mapdata?page="+encodeURIComponent(page);
+    georequest.open("GET", url, true);
+    georequest.onreadystatechange = t2map_contact_reply;
+    georequest.send(null);
+}
+
 // bound to onkeypress event in search box
 function send_on_return(event) {
     if (event.keyCode == 13) {
@@ -14,7 +14,8 @@ from google.appengine.ext import db
 from google.appengine.api import memcache
 from take2dbm import Contact, Person, Take2, FuzzyDate
 from take2dbm import Email, Address, Mobile, Web, Other, OtherTag
-from take2index import update_index
+from take2index import schedule_index_update
+from take2changes import log_change
 
 
 def prepare_list_of_other_tags():
@@ -179,8 +180,9 @@ class PersonBean(ContactBean):
                                 introduction=self.introduction, middleman_ref=middleman)
             self.entity.put()
         if not self.parent:
-            # generate search keys for contact; cannot run in transaction context
-            update_index(self.entity)
+            # log the change and generate search keys for contact; cannot run in transaction context
+            log_change(self.entity, 'put')
+            schedule_index_update(self.entity)
         # delete birthday memcache
         memcache.delete('birthdays',namespace=str(self.entity.owned_by.key()))
 
@@ -237,6 +239,8 @@ class EmailBean(Take2Bean):
         except AttributeError:
             self.entity = Email(contact_ref=self.contact_ref, email=self.email)
             self.entity.put()
+        log_change(self.entity, 'put')
+        schedule_index_update(self.entity)
 
 
 class MobileBean(Take2Bean):
@@ -284,6 +288,8 @@ class MobileBean(Take2Bean):
             # prepare database object for new person
             self.entity = Mobile(contact_ref=self.contact_ref, mobile=self.mobile)
             self.entity.put()
+        log_change(self.entity, 'put')
+        schedule_index_update(self.entity)
 
 
 class WebBean(Take2Bean):
@@ -333,6 +339,8 @@ class WebBean(Take2Bean):
             # prepare database object for new person
             self.entity = Web(contact_ref=self.contact_ref, web=self.web)
             self.entity.put()
+        log_change(self.entity, 'put')
+        schedule_index_update(self.entity)
 
 
 class OtherBean(Take2Bean):
@@ -394,6 +402,8 @@ class OtherBean(Take2Bean):
             # prepare database object for new person
             self.entity = Other(contact_ref=self.contact_ref, text=self.text, tag=tag)
             self.entity.put()
+        log_change(self.entity, 'put')
+        schedule_index_update(self.entity)
 
 
 class AddressBean(Take2Bean):
@@ -480,7 +490,8 @@ class AddressBean(Take2Bean):
                                   location=db.GeoPt(lon=self.lon, lat=self.lat), location_lock=self.location_lock,
                                   map_zoom=self.map_zoom, adr_zoom=self.adr_zoom)
             self.entity.put()
-        update_index(self.entity)
+        log_change(self.entity, 'put')
+        schedule_index_update(self.entity)
 
 
 def main():
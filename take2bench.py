@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""Take2 benchmark for the text functions of the search index
+
+Run with python take2bench.py (no App Engine environment needed).
+Checks that plainify returns the same result as the reference
+implementation for a synthetic corpus of names and reports the
+throughput of both.
+
+"""
+
+import sys
+import time
+import random
+import unicodedata
+import take2text
+from take2text import plainify
+
+def plainify_reference(string):
+    """The original plainify implementation (one normalization per word)"""
+    res = []
+    for s1 in string.split(" "):
+        s1 = s1.strip(",.;:\\?/!@#$%^&*()[]{}|\"'")
+        s1 = unicode(s1)
+        s1 = unicodedata.normalize('NFD',s1.lower())
+        s1 = s1.replace("`", "")
+        s1 = s1.encode('ascii','ignore')
+        s1 = s1.replace("~", "")
+        s1 = s1.strip()
+        if len(s1):
+            res.append(s1)
+
+    return res
+
+
+# name parts of several languages (and some noise) for the corpus
+NAMES = [u"Müller", u"Jürgen", u"Björk", u"François", u"José", u"Zoë",
+         u"Åse", u"Søren", u"Łukasz", u"Dávid", u"Šimon", u"Renée",
+         u"Núñez", u"González", u"Öztürk", u"Çelik", u"Dvořák",
+         u"Straße", u"Ælfred", u"O'Brien", u"Smith-Jones", u"van der Berg", u"D'Angelo",
+         u"Ngưễn", u"Анна", u"Σωκράτης",
+         u"张伟", u"田中", u"김민준", u"Tom`s", u"~tilde~", u"(Hans)",
+         u"\"Nick\"", u"Zürich,", u"Málaga.", u"São Paulo", u"København", u"ab\tcd",
+         u" Jane ", u"x́y̧", u"ALL CAPS", u"¿Qué?", u"100%", u""]
+
+def make_corpus(size, seed=1):
+    """Returns size random search strings made of 1-3 name parts"""
+    rnd = random.Random(seed)
+    return [u" ".join([rnd.choice(NAMES) for n in range(rnd.randint(1,3))]) for i in range(size)]
+
+
+def throughput(function, corpus):
+    """Returns the number of strings per second function processes"""
+    start = time.time()
+    for string in corpus:
+        function(string)
+    elapsed = time.time() - start
+    return len(corpus) / elapsed if elapsed > 0 else float('inf')
+
+
+def main(size=100000):
+    corpus = make_corpus(size)
+    # every distinct word is checked, also the ones not in the corpus
+    for string in set(corpus + NAMES + [unichr(code) for code in range(0x3000)]):
+        expected = plainify_reference(string)
+        result = plainify(string)
+        if result != expected or [type(word) for word in result] != [type(word) for word in expected]:
+            print "Mismatch for %r: %r != %r" % (string,result,expected)
+            return 1
+    print "plainify matches the reference for %d strings." % (len(corpus))
+
+    reference = throughput(plainify_reference, corpus)
+    take2text._plainify_memo.clear()
+    fast = throughput(plainify, corpus)
+    print "reference: %10.0f strings/s" % (reference)
+    print "plainify:  %10.0f strings/s (%.1fx)" % (fast,fast/reference)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
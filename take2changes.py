@@ -0,0 +1,72 @@
+"""Take2 change log of contacts and their data
+
+Every save, attic and deattic of a Contact or Take2 dataset is appended
+to the owner's ChangeLog. Consumers keep a watermark and read only the
+changes since their last visit instead of scanning all datasets.
+
+"""
+
+import settings
+import logging
+from datetime import datetime, timedelta
+from take2dbm import Contact, ChangeLog
+
+
+def change_entry(obj, operation, contact=None):
+    """Returns a (not yet stored) ChangeLog entry for a change of obj, so
+    that the changes of many datasets can be stored with one db.put.
+    contact is the contact of a Take2 dataset if it was already read.
+    Returns None if the contact has no owner.
+    """
+    if isinstance(obj, Contact):
+        contact = obj
+    elif contact is None:
+        contact = obj.contact_ref
+    owned_by = Contact.owned_by.get_value_for_datastore(contact)
+    if not owned_by:
+        logging.warning("log_change(): %s has no owner" % (str(contact.key())))
+        return None
+    return ChangeLog(owned_by=owned_by, data_ref=obj, contact_ref=contact,
+                     data_class=obj.class_name(), operation=operation)
+
+
+def log_change(obj, operation):
+    """Appends a change of obj (a Contact or Take2 dataset) to the
+    owner's log. Call it after obj was stored.
+
+    operation is 'put', 'attic' or 'deattic'. The entry is a root entity,
+    so it cannot be written in a transaction with obj.
+    """
+    entry = change_entry(obj, operation)
+    if entry:
+        entry.put()
+    return entry
+
+
+def read_changes(owned_by, cursor=None, limit=None, since=None, until=None):
+    """Returns the changes of a user's data (owned_by is a LoginUser or its
+    key) in the order they were made, starting at cursor (None for the
+    oldest change) and restricted to the timestamps after since.
+
+    The timestamps are set before the changes are committed, so a change
+    may become visible after later ones. Changes of the last
+    settings.SYNC_SAFETY_MARGIN seconds are therefore left out (until
+    defaults to that point in time). A consumer keeps until as its
+    watermark and passes it as since next time.
+
+    Returns a list of at most limit ChangeLog entries and the cursor
+    where the next call continues.
+    """
+    if limit is None:
+        limit = settings.CHANGES_BATCH_SIZE
+    if until is None:
+        until = datetime.now() - timedelta(seconds=settings.SYNC_SAFETY_MARGIN)
+    query = ChangeLog.all().filter('owned_by =', owned_by)
+    if since:
+        query.filter('timestamp >', since)
+    query.filter('timestamp <=', until)
+    query.order('timestamp')
+    if cursor:
+        query.with_cursor(cursor)
+    changes = query.fetch(limit)
+    return changes,query.cursor()
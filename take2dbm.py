@@ -206,6 +206,24 @@ class Other(Take2):
     # content
     text = db.StringProperty()
 
+class ChangeLog(db.Model):
+    """Append-only log of the changes to a user's contacts and their data.
+
+    The entries are root entities which are read by owner in timestamp
+    order (see take2changes). Parallel tasks can write them without
+    contending for one entity group.
+    """
+    owned_by = db.ReferenceProperty(LoginUser)
+    # changed dataset (Contact or Take2)
+    data_ref = db.ReferenceProperty()
+    # contact to which the dataset belongs
+    contact_ref = db.ReferenceProperty(Contact, collection_name='changes')
+    # class of the changed dataset, e.g. Person or Email
+    data_class = db.StringProperty()
+    # put, attic or deattic
+    operation = db.StringProperty()
+    timestamp = db.DateTimeProperty(auto_now_add=True)
+
 class SearchIndex(db.Model):
     """Combined index for efficient search in
 
@@ -224,6 +242,17 @@ class SearchIndex(db.Model):
     data_ref = db.ReferenceProperty()
     # pointer to contact
     contact_ref = db.ReferenceProperty(Contact)
+    # owner of the contact. Partitions the index so that a search only
+    # scans the rows which belong to one address book
+    owned_by = db.ReferenceProperty(LoginUser)
+    # index generation (see IndexGeneration)
+    generation = db.IntegerProperty(default=0)
+    # trigrams of the keys for typo tolerant search
+    # (only filled if settings.TRIGRAM_INDEX is set)
+    grams = db.StringListProperty()
+    # phonetic codes of name, last name and nickname
+    # for sound-alike search (Cologne phonetics)
+    phonetic = db.StringListProperty()
 
 class GeoIndex(GeoModel):
     """Indexes the location fields in LoginUser and Address datasets
@@ -243,6 +272,196 @@ class GeoIndex(GeoModel):
     data_ref = db.ReferenceProperty()
     # pointer to contact
     contact_ref = db.ReferenceProperty(Contact)
+    # owner of the contact (see SearchIndex)
+    owned_by = db.ReferenceProperty(LoginUser)
+    # index generation (see IndexGeneration)
+    generation = db.IntegerProperty(default=0)
+
+class IndexGeneration(db.Model):
+    """Points to the generation of SearchIndex and GeoIndex entries
+    which is used for searches.
+
+    A rebuild writes a new generation next to the current one and
+    switches over when it is complete.
+    """
+    # generation which is read by searches
+    current = db.IntegerProperty(default=0)
+    # generation which is being built (None if no rebuild is running)
+    building = db.IntegerProperty()
+
+class IndexJob(db.Model):
+    """Checkpoint of an index rebuild, purge or migration which runs as a chain of tasks.
+
+    Every task handles one page of a table and stores the position
+    where the next task continues.
+    """
+    # name of the table which is currently processed
+    table = db.StringProperty()
+    # datastore cursor pointing behind the last processed page
+    cursor = db.TextProperty()
+    # sequence number of the task which may continue the job
+    step = db.IntegerProperty(default=0)
+    # index generation which is written by the job
+    # (purge: generation which is deleted, None for all)
+    generation = db.IntegerProperty(default=0)
+    # purge: only delete the index of this user (None for all)
+    owned_by = db.ReferenceProperty(LoginUser)
+    # number of processed datasets
+    count = db.IntegerProperty(default=0)
+    # datasets per second
+    rate = db.FloatProperty(default=0.0)
+    done = db.BooleanProperty(default=False)
+    started = db.DateTimeProperty()
+    timestamp = db.DateTimeProperty(auto_now=True)
+
+class FixReport(db.Model):
+    """Progress and findings of one shard of a database check (/fix).
+
+    A shard checks a key range of one table as a chain of tasks.
+    The key name is made up of table and shard number.
+    """
+    table = db.StringProperty()
+    # key range of the shard (None for open ends)
+    start = db.StringProperty()
+    end = db.StringProperty()
+    # delete datasets with invalid references
+    fix = db.BooleanProperty(default=False)
+    # datastore cursor pointing behind the last checked page
+    cursor = db.TextProperty()
+    # sequence number of the task which may continue the shard
+    step = db.IntegerProperty(default=0)
+    checked = db.IntegerProperty(default=0)
+    broken = db.IntegerProperty(default=0)
+    fixed = db.IntegerProperty(default=0)
+    # descriptions of the broken datasets (see settings.FIX_MAX_FINDINGS)
+    findings = db.StringListProperty(indexed=False)
+    done = db.BooleanProperty(default=False)
+    started = db.DateTimeProperty()
+    timestamp = db.DateTimeProperty(auto_now=True)
+
+class ExportJob(db.Model):
+    """Background export of all contacts started by the administrator.
+
+    There is only one job (key name 'export'). The work is split into
+    ExportShard key ranges which write their output to ExportChunk entities.
+    """
+    # sequence number of the export, incremented for every new export
+    number = db.IntegerProperty(default=0)
+    # JSON or yaml
+    format = db.StringProperty()
+    attic = db.BooleanProperty(default=False)
+    # administrator who started the export
+    login_user = db.ReferenceProperty(LoginUser)
+    shards = db.IntegerProperty(default=0)
+    started = db.DateTimeProperty()
+
+class ExportShard(db.Model):
+    """Progress of one key range of an export. The key name is made up
+    of export number and shard number."""
+    job = db.IntegerProperty()
+    shard = db.IntegerProperty()
+    # key range of the shard (None for open ends)
+    start = db.StringProperty()
+    end = db.StringProperty()
+    # datastore cursor pointing behind the last exported page
+    cursor = db.TextProperty()
+    # sequence number of the task which may continue the shard
+    step = db.IntegerProperty(default=0)
+    # number of exported contacts and written chunks
+    count = db.IntegerProperty(default=0)
+    chunks = db.IntegerProperty(default=0)
+    done = db.BooleanProperty(default=False)
+    timestamp = db.DateTimeProperty(auto_now=True)
+
+class ExportChunk(db.Model):
+    """Output of one page of an export shard: a complete JSON or YAML
+    list of contacts. The key name is made up of export number, shard
+    number and chunk number."""
+    job = db.IntegerProperty()
+    data = db.TextProperty()
+    count = db.IntegerProperty(default=0)
+
+class ImportChunk(db.Model):
+    """Piece of an uploaded import file which is staged until the import
+    task reads it. The key name is made up of upload and chunk number."""
+    data = db.TextProperty()
+    timestamp = db.DateTimeProperty(auto_now_add=True)
+
+class ImportJob(db.Model):
+    """Import of a user's data. Every user has one job (the key name is
+    the LoginUser's key) so that imports of different users run side by
+    side. A new import replaces the job of the previous one."""
+    login_user = db.ReferenceProperty(LoginUser)
+    # name of the staged upload (see ImportChunk) and its number of chunks
+    upload = db.StringProperty()
+    chunks = db.IntegerProperty(default=0)
+    # JSON or yaml
+    format = db.StringProperty()
+    # checkpoint of the import task: 0 delete data, 1 split into batches, 2 done
+    step = db.IntegerProperty(default=0)
+    # number of contacts in the batches queued so far
+    position = db.IntegerProperty(default=0)
+    # step 0: cursor behind the last deleted page of contacts and their number
+    cursor = db.TextProperty()
+    deleted = db.IntegerProperty(default=0)
+    # number of ImportBatch entities, 0 until the upload is split
+    batches = db.IntegerProperty(default=0)
+    # numbers of the batches which are done
+    finished = db.ListProperty(int, indexed=False)
+    # merge into the existing data instead of replacing it
+    merge = db.BooleanProperty(default=False)
+    # report: numbers of inserted, updated and unchanged datasets
+    inserted = db.IntegerProperty(default=0)
+    updated = db.IntegerProperty(default=0)
+    unchanged = db.IntegerProperty(default=0)
+    status = db.StringProperty(indexed=False)
+    done = db.BooleanProperty(default=False)
+    started = db.DateTimeProperty()
+    timestamp = db.DateTimeProperty(auto_now=True)
+
+class ImportBatch(db.Model):
+    """Contacts of an import which are imported by one task. The key name
+    is made up of upload and batch number. The imported keys, links and
+    candidates for the user's own Person are kept until all batches
+    are done."""
+    upload = db.StringProperty()
+    number = db.IntegerProperty()
+    data = db.TextProperty()
+    done = db.BooleanProperty(default=False)
+    # number of imported contacts
+    count = db.IntegerProperty(default=0)
+    # numbers of inserted, updated and unchanged datasets
+    inserted = db.IntegerProperty(default=0)
+    updated = db.IntegerProperty(default=0)
+    unchanged = db.IntegerProperty(default=0)
+    # "<key in import file> <new key>"
+    key_map = db.StringListProperty(indexed=False)
+    # "<new key> <key in import file of the linked contact>"
+    links = db.StringListProperty(indexed=False)
+    # keys of contacts with the user's email address
+    me = db.StringListProperty(indexed=False)
+    timestamp = db.DateTimeProperty(auto_now_add=True)
+
+class CounterShard(db.Model):
+    """Part of a counter which is updated by parallel tasks. The key name
+    is made up of counter name and shard number."""
+    name = db.StringProperty()
+    count = db.IntegerProperty(default=0)
+
+class PrefixBucket(db.Model):
+    """Search keywords of one user which start with the same letter
+    (for autocompletion). The key name is the letter, the parent key is
+    made up of index generation and owner key, so that the buckets of a
+    user form one entity group.
+
+    counts holds the number of non-attic SearchIndex entries for
+    each keyword in tokens.
+    """
+    generation = db.IntegerProperty(default=0)
+    owned_by = db.ReferenceProperty(LoginUser)
+    prefix = db.StringProperty()
+    tokens = db.StringListProperty(indexed=False)
+    counts = db.ListProperty(int, indexed=False)
 
 
 class SharedTake2(polymodel.PolyModel):
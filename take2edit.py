@@ -22,7 +22,8 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 from take2dbm import Person, Contact, Take2, Address
 from take2access import MembershipRequired, write_access, visible_contacts
 from take2view import encode_contact
-from take2index import update_index
+from take2index import schedule_index_update
+from take2changes import log_change
 from take2beans import PersonBean, EmailBean, MobileBean, AddressBean, WebBean, OtherBean
 
 class ContactEdit(webapp.RequestHandler):
@@ -234,7 +235,11 @@ class Attic(webapp.RequestHandler):
 
         contact.attic = True;
         contact.put();
-        update_index(contact)
+        log_change(contact, 'attic')
+        schedule_index_update(contact)
+        # the index entries of the take2 data (and GeoIndex) inherit the attic flag
+        for t2 in Take2.all().filter("contact_ref =", contact):
+            schedule_index_update(t2)
 
         # if the contact had a backwards refrence, direkt to the middleman
         if contact.middleman_ref:
@@ -262,8 +267,8 @@ class Attic(webapp.RequestHandler):
 
         t2.attic = True;
         t2.put();
-        if t2.class_name() == 'Address':
-            update_index(t2)
+        log_change(t2, 'attic')
+        schedule_index_update(t2)
 
         self.redirect('/editcontact?key=%s' % str(contact.key()))
 
@@ -292,7 +297,11 @@ class Deattic(webapp.RequestHandler):
 
         contact.attic = False;
         contact.put();
-        update_index(contact)
+        log_change(contact, 'deattic')
+        schedule_index_update(contact)
+        # the index entries of the take2 data (and GeoIndex) inherit the attic flag
+        for t2 in Take2.all().filter("contact_ref =", contact):
+            schedule_index_update(t2)
 
         self.redirect('/editcontact?key=%s' % key)
 
@@ -314,8 +323,8 @@ class Deattic(webapp.RequestHandler):
 
         t2.attic = False;
         t2.put();
-        if t2.class_name() == 'Address':
-            update_index(t2)
+        log_change(t2, 'deattic')
+        schedule_index_update(t2)
 
         self.redirect('/editcontact?key=%s' % str(contact.key()))
 
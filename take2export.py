@@ -4,6 +4,9 @@ import settings
 import logging
 import os
 import yaml
+import time
+import base64
+import random
 from django.utils import simplejson as json
 import datetime
 from google.appengine.ext import db
@@ -16,58 +19,74 @@ from google.appengine.api import taskqueue
 from google.appengine.api import memcache
 from take2dbm import Contact, Person, Company, Take2, FuzzyDate, LoginUser, OtherTag
 from take2dbm import Email, Address, Mobile, Web, Other, Country
+from take2dbm import ExportJob, ExportShard, ExportChunk, ImportChunk, ImportBatch, ImportJob
+from take2dbm import CounterShard
 from take2access import get_current_user_template_values, visible_contacts, get_login_user
+from take2view import prefetch_take2, resolve_take2_references
+from take2index import key_ranges, advance_checkpoint, schedule_index_update, delete_index, update_index, store_index_update, lookup_cache_seed
+from take2text import json_list_items, yaml_list_items
+from take2changes import change_entry
 
-def encode_take2(contact, include_attic=False):
+def encode_take2(contact, include_attic=False, take2=None):
     """Encodes the contact's take2 property objects
 
     Returns a dictionary with the property's name
     as the key and a list of properties as values.
+    take2 are the contact's take2 objects if they were already read
+    (see take2view.prefetch_take2).
     """
     restypes = {}
-    for take2 in [Email,Web,Address,Mobile,Other]:
-        restypes[take2.class_name().lower()] = []
+    for cls in [Email,Web,Address,Mobile,Other]:
+        restypes[cls.class_name().lower()] = []
 
-    q_obj = Take2.all()
-    q_obj.filter("contact_ref =", contact)
-    q_obj.order('-timestamp')
-    for obj in q_obj:
+    if take2 is None:
+        q_obj = Take2.all()
+        q_obj.filter("contact_ref =", contact)
+        q_obj.order('-timestamp')
+        take2 = q_obj.fetch(1000)
+        resolve_take2_references(take2)
+    for obj in take2:
         # do only enclose non-attic take2 properties unless attic parameter is set
         if obj.attic and not include_attic:
             continue
-        res = {}
-        res['key'] = str(obj.key())
-        res['type'] = obj.class_name().lower()
-        res['timestamp'] = obj.timestamp.isoformat()
-        res['attic'] = obj.attic
-        if obj.class_name() == "Email":
-            res['email'] = obj.email
-        elif obj.class_name() == "Web":
-            res['web'] = obj.web
-        elif obj.class_name() == "Address":
-            if obj.location:
-                res['location_lat'] = obj.location.lat
-                res['location_lon'] = obj.location.lon
-            res['adr'] = obj.adr
-            if obj.landline_phone:
-                res['landline_phone'] = obj.landline_phone
-            if obj.country:
-                res['country'] = obj.country.country
-            if obj.adr_zoom:
-                res['adr_zoom'] = obj.adr_zoom
-        elif obj.class_name() == "Mobile":
-            res['mobile'] = obj.mobile
-        elif obj.class_name() == "Other":
-            res['tag'] = obj.tag.tag
-            res['text'] = obj.text
-        else:
-            assert True, "Invalid class name: %s" % obj.class_name()
-        restypes[obj.class_name().lower()].append(res)
+        restypes[obj.class_name().lower()].append(encode_take2_object(obj))
 
     return restypes
 
 
-def encode_contact(contact, login_user, include_attic=False, is_admin=False):
+def encode_take2_object(obj):
+    """Encodes one take2 property object as a dictionary"""
+    res = {}
+    res['key'] = str(obj.key())
+    res['type'] = obj.class_name().lower()
+    res['timestamp'] = obj.timestamp.isoformat()
+    res['attic'] = obj.attic
+    if obj.class_name() == "Email":
+        res['email'] = obj.email
+    elif obj.class_name() == "Web":
+        res['web'] = obj.web
+    elif obj.class_name() == "Address":
+        if obj.location:
+            res['location_lat'] = obj.location.lat
+            res['location_lon'] = obj.location.lon
+        res['adr'] = obj.adr
+        if obj.landline_phone:
+            res['landline_phone'] = obj.landline_phone
+        if obj.country:
+            res['country'] = obj.country.country
+        if obj.adr_zoom:
+            res['adr_zoom'] = obj.adr_zoom
+    elif obj.class_name() == "Mobile":
+        res['mobile'] = obj.mobile
+    elif obj.class_name() == "Other":
+        res['tag'] = obj.tag.tag
+        res['text'] = obj.text
+    else:
+        assert True, "Invalid class name: %s" % obj.class_name()
+    return res
+
+
+def encode_contact(contact, login_user, include_attic=False, is_admin=False, take2=None):
     """Encodes Contact data for export and returns a python data structure of dictionaries and lists.
 
     The function takes into account the access rights and encodes only elements
@@ -75,6 +94,7 @@ def encode_contact(contact, login_user, include_attic=False, is_admin=False):
     me is set to the user's own database entry (or None if not logged in or not in the DB)
     signed_in is set to True if the user is signed in
     If attic=True, data will include the complete history and also archived data.
+    take2 are the contact's take2 objects if they were already read.
     """
     logging.debug("encode contact name: %s" % (contact.name))
     res = {}
@@ -118,27 +138,51 @@ def encode_contact(contact, login_user, include_attic=False, is_admin=False):
                     'federated_identity': contact.owned_by.user.federated_identity(),
                     'federated_provider': contact.owned_by.user.federated_provider()}
     # references other contact
-    if contact.relation:
-        res['introduction'] = contact.relation
-    if middleman_ref:
-        res['middleman_ref'] = contact.middleman_ref
+    if contact.introduction:
+        res['introduction'] = contact.introduction
+    middleman = Contact.middleman_ref.get_value_for_datastore(contact)
+    if middleman:
+        res['middleman_ref'] = str(middleman)
 
     # takes care of the different take2 object structures
-    res.update(encode_take2(contact, include_attic))
+    res.update(encode_take2(contact, include_attic, take2))
 
     return res
 
 
+def encode_export_token(cursor, attic, count):
+    """Returns an opaque token where a partial export continues"""
+    return base64.urlsafe_b64encode(json.dumps({'cursor': cursor, 'attic': attic, 'count': count}))
+
+def decode_export_token(token):
+    """Returns cursor, attic and count of an export continuation token"""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(str(token)))
+        return state['cursor'],bool(state['attic']),int(state['count'])
+    except (TypeError, ValueError, KeyError):
+        logging.warning("Invalid export token: %s" % (token))
+        return None,None,None
+
+
 class Take2Export(webapp.RequestHandler):
     """Export the relation between icons and osm tags (backup)"""
 
     def get(self):
+        """Writes the contacts page by page to the response
+
+        The administrator exports all contacts, other users their own.
+        A large export is split into parts: if settings.EXPORT_TIME_LIMIT
+        seconds are used up, the response ends after the current page and
+        the header X-Take2-Continue holds a token. Calling /export with
+        continue=token (and the same format) returns the next part. Every
+        part is a complete JSON or YAML list.
+        """
         login_user = get_login_user()
 
         format = self.request.get("format", "JSON")
 
         if format not in ['JSON','yaml']:
-            logging.Critical("Unknown format for export: %s" % (format))
+            logging.critical("Unknown format for export: %s" % (format))
             self.error(500)
             return
 
@@ -147,7 +191,16 @@ class Take2Export(webapp.RequestHandler):
             self.redirect('/login')
             return
 
-        if self.request.get('attic',"") == 'True':
+        is_admin = users.is_current_user_admin()
+        cursor = None
+        count = 0
+        token = self.request.get("continue", None)
+        if token:
+            cursor,attic,count = decode_export_token(token)
+            if cursor is None:
+                self.error(400)
+                return
+        elif self.request.get('attic',"") == 'True':
             attic = True
         else:
             attic = False
@@ -155,40 +208,261 @@ class Take2Export(webapp.RequestHandler):
         # shall a specific dataset be exported?
         key = self.request.get("key", None)
 
+        logging.info("export format: %s attic: %d user: %s admin: %d" % (format,attic,login_user.user.nickname(),is_admin))
 
-        logging.info("export format:  attic: %d user: %s admin: %d" % (attic,user.nickname(),users.is_current_user_admin()))
-        self.response.headers['Content-Type'] = 'text/plain'
-
-        # Administrator exports everything
-        contacts = []
-        if users.is_current_user_admin():
-            if key:
-                con = Contact.get(key)
-                if con:
-                    contacts.append(encode_contact(con, include_attic=attic, signed_in=True, is_admin=True))
-            else:
-                q_con = Contact.all()
-                for con in q_con:
-                    contacts.append(encode_contact(con, include_attic=attic, signed_in=True, is_admin=True))
+        if key:
+            contacts = [con for con in [Contact.get(key)] if con]
+            query = None
         else:
-            login_user = get_login_user(user)
-            if key:
-                con = Contact.get(key)
-                if con:
-                    contacts.append(encode_contact(con, include_attic=attic, signed_in=True, is_admin=True))
-            else:
-                # export everything this user can see
-                for ckey in visible_contacts(login_user, include_attic=attic):
-                    con = Contact.get(ckey)
-                    contacts.append(encode_contact(con, include_attic=attic, me=login_user.me))
+            # Administrator exports everything
+            query = Contact.all()
+            if not is_admin:
+                query.filter("owned_by =", login_user)
+            if not attic:
+                query.filter("attic =", False)
+            try:
+                if cursor:
+                    query.with_cursor(cursor)
+                contacts = query.fetch(settings.EXPORT_BATCH_SIZE)
+            except (db.BadRequestError, db.BadValueError):
+                # the cursor does not belong to this query
+                logging.warning("Invalid export token: %s" % (token))
+                self.error(400)
+                return
 
-        self.response.headers['Content-Disposition'] = "attachment; filename=address_export.json"
+        self.response.headers['Content-Disposition'] = "attachment; filename=address_export.%s" % ('json' if format == 'JSON' else 'yaml')
         if format == 'JSON':
             self.response.headers['Content-Type'] = "text/plain"
-            self.response.out.write(json.dumps(contacts,indent=2))
+            self.response.out.write("[")
         else:
             self.response.headers['Content-Type'] = "text/yaml"
-            self.response.out.write(yaml.dump(contacts,))
+
+        start = time.time()
+        written = 0
+        while True:
+            take2 = prefetch_take2(contacts, include_attic=attic)
+            for con in contacts:
+                contact = encode_contact(con, login_user, include_attic=attic, is_admin=is_admin,
+                                         take2=take2[con.key()])
+                if format == 'JSON':
+                    self.response.out.write("%s\n%s" % ("," if written else "",json.dumps(contact,indent=2)))
+                else:
+                    self.response.out.write(yaml.dump([contact]))
+                written = written + 1
+            if not query or len(contacts) < settings.EXPORT_BATCH_SIZE:
+                break
+            if time.time() - start > settings.EXPORT_TIME_LIMIT:
+                # the rest is exported by the next call
+                self.response.headers['X-Take2-Continue'] = encode_export_token(query.cursor(), attic, count+written)
+                break
+            # fetch() starts at the cursor set with with_cursor()
+            query.with_cursor(query.cursor())
+            contacts = query.fetch(settings.EXPORT_BATCH_SIZE)
+
+        if format == 'JSON':
+            self.response.out.write("\n]\n")
+        logging.info("export wrote %d contacts (%d before)." % (written,count))
+
+def export_chunk_name(number, shard, chunk):
+    """Returns the key name of an ExportChunk"""
+    return "%d:%03d:%06d" % (number,shard,chunk)
+
+def export_job_status(job, shards):
+    """Returns a line of text describing the progress of a background export"""
+    done = len([shard for shard in shards if shard.done])
+    return "Export %d: %d of %d shards done, %d contacts exported." % (job.number,done,len(shards),
+                                                                       sum([shard.count for shard in shards]))
+
+def export_shards(job):
+    """Returns the ExportShard entities of job"""
+    return ExportShard.get_by_key_name(["%d:%d" % (job.number,n) for n in range(job.shards)])
+
+def enqueue_export_task(shard, transactional=False):
+    """Queues the task which exports the next page of an ExportShard"""
+    taskqueue.add(url='/export_task', queue_name="export",
+                  params={'shard': shard.key().name(), 'step': shard.step},
+                  transactional=transactional)
+
+
+class Take2ExportJob(webapp.RequestHandler):
+    """Used by administrator"""
+
+    def get(self):
+        """Starts a background export of all contacts
+
+        The contacts are split into up to settings.EXPORT_SHARDS key ranges
+        which are exported in parallel by chains of tasks (see
+        Take2ExportTask). The progress is shown on /import_status, the
+        result is listed by /export_manifest. While an export is running
+        a new one is only started with restart=True.
+        """
+        if not users.is_current_user_admin():
+            logging.critical("Take2ExportJob called by non-admin")
+            self.error(500)
+            return
+
+        format = self.request.get("format", "JSON")
+        if format not in ['JSON','yaml']:
+            logging.critical("Unknown format for export: %s" % (format))
+            self.error(500)
+            return
+
+        job = ExportJob.get_by_key_name('export')
+        if job and not self.request.get("restart", None):
+            if [shard for shard in export_shards(job) if shard and not shard.done]:
+                self.redirect('/import_status')
+                return
+
+        def next_number():
+            job = ExportJob.get_by_key_name('export')
+            if not job:
+                job = ExportJob(key_name='export')
+            job.number = job.number + 1
+            job.put()
+            return job.number
+        number = db.run_in_transaction(next_number)
+
+        ranges = key_ranges(Contact, settings.EXPORT_SHARDS)
+        job = ExportJob(key_name='export', number=number, format=format,
+                        attic=True if self.request.get('attic',"") == 'True' else False,
+                        login_user=get_login_user(), shards=len(ranges), started=datetime.datetime.now())
+        shards = []
+        for n,(start,end) in enumerate(ranges):
+            shards.append(ExportShard(key_name="%d:%d" % (number,n), job=number, shard=n,
+                                      start=str(start) if start else None,
+                                      end=str(end) if end else None))
+        db.put([job] + shards)
+        for shard in shards:
+            enqueue_export_task(shard)
+        # remove the output of older exports
+        taskqueue.add(url='/export_gc', queue_name="export", params={'number': number})
+        logging.info("Export %d started with %d shards." % (number,len(shards)))
+        self.redirect('/import_status')
+
+
+class Take2ExportTask(webapp.RequestHandler):
+    """Used by task queue (queued by Take2ExportJob)"""
+
+    def post(self):
+        """Exports one page of a shard's key range into an ExportChunk
+
+        The chunk's key name is derived from its position, so a retried
+        task overwrites its own output. The checkpoint is advanced like
+        the one of the index rebuild (see take2index.advance_checkpoint).
+        """
+        shard = ExportShard.get_by_key_name(self.request.get("shard"))
+        step = int(self.request.get("step", "0"))
+        job = ExportJob.get_by_key_name('export')
+        if not shard or shard.done or shard.step != step or not job or job.number != shard.job:
+            logging.info("Export task step %d is outdated." % (step))
+            return
+
+        query = Contact.all()
+        if shard.start:
+            query.filter("__key__ >=", Key(shard.start))
+        if shard.end:
+            query.filter("__key__ <", Key(shard.end))
+        if shard.cursor:
+            query.with_cursor(shard.cursor)
+        page = query.fetch(settings.EXPORT_BATCH_SIZE)
+
+        login_user = job.login_user
+        take2 = prefetch_take2(page, include_attic=job.attic)
+        contacts = []
+        for con in page:
+            contact = encode_contact(con, login_user, include_attic=job.attic, is_admin=True,
+                                     take2=take2[con.key()])
+            # archived contacts are encoded empty
+            if contact:
+                contacts.append(contact)
+        if contacts:
+            if job.format == 'JSON':
+                data = json.dumps(contacts,indent=2)
+            else:
+                data = yaml.dump(contacts)
+            ExportChunk(key_name=export_chunk_name(job.number,shard.shard,shard.chunks),
+                        job=job.number, data=db.Text(data, encoding="utf-8"), count=len(contacts)).put()
+            shard.chunks = shard.chunks + 1
+
+        # advance the checkpoint
+        shard.count = shard.count + len(contacts)
+        if len(page) == settings.EXPORT_BATCH_SIZE:
+            shard.cursor = query.cursor()
+        else:
+            shard.done = True
+        advance_checkpoint(shard, step, enqueue_export_task)
+
+
+class Take2ExportManifest(webapp.RequestHandler):
+    """Used by administrator"""
+
+    def get(self):
+        """Returns the manifest of the last background export as JSON:
+        its state and the links to its chunks in order. Every chunk is a
+        complete JSON or YAML list of contacts."""
+        if not users.is_current_user_admin():
+            logging.critical("Take2ExportManifest called by non-admin")
+            self.error(500)
+            return
+
+        job = ExportJob.get_by_key_name('export')
+        if not job or not job.shards:
+            self.error(404)
+            return
+        shards = export_shards(job)
+        res = {'export': job.number, 'format': job.format, 'attic': job.attic,
+               'started': job.started.isoformat(),
+               'done': not [shard for shard in shards if not shard.done],
+               'count': sum([shard.count for shard in shards]),
+               'chunks': []}
+        for shard in shards:
+            for chunk in range(shard.chunks):
+                res['chunks'].append("/export_chunk?name=%s" % (export_chunk_name(job.number,shard.shard,chunk)))
+
+        self.response.headers['Content-Type'] = "text/plain"
+        self.response.headers['Content-Disposition'] = "attachment; filename=address_export_manifest.json"
+        self.response.out.write(json.dumps(res,indent=2))
+
+
+class Take2ExportChunk(webapp.RequestHandler):
+    """Used by administrator"""
+
+    def get(self):
+        """Returns one chunk of a background export"""
+        if not users.is_current_user_admin():
+            logging.critical("Take2ExportChunk called by non-admin")
+            self.error(500)
+            return
+
+        chunk = ExportChunk.get_by_key_name(self.request.get("name", ""))
+        if not chunk:
+            self.error(404)
+            return
+        job = ExportJob.get_by_key_name('export')
+        if job and job.format == 'yaml':
+            self.response.headers['Content-Type'] = "text/yaml"
+        else:
+            self.response.headers['Content-Type'] = "text/plain"
+        self.response.out.write(chunk.data)
+
+
+class CollectExportGarbage(webapp.RequestHandler):
+    """Used by task queue (queued by Take2ExportJob)"""
+
+    def post(self):
+        """Deletes a batch of chunks and shards of exports older than number
+        and queues itself again until all of them are gone"""
+        number = int(self.request.get("number"))
+        count = 0
+        for table in [ExportChunk,ExportShard]:
+            query = db.Query(table, keys_only=True)
+            query.filter("job <", number)
+            keys = query.fetch(settings.EXPORT_BATCH_SIZE)
+            db.delete(keys)
+            count = count + len(keys)
+        if count:
+            taskqueue.add(url='/export_gc', queue_name="export", params={'number': number})
+
 
 class Take2SelectImportFile(webapp.RequestHandler):
     """Present upload form for import file"""
@@ -212,6 +486,81 @@ def  load_country_list():
             country = Country(ccode=cc,country=c)
             country.put()
 
+def import_chunk_name(upload, chunk):
+    """Returns the key name of an ImportChunk"""
+    return "%s:%06d" % (upload,chunk)
+
+def stage_import(login_user, data):
+    """Stores an uploaded import file in ImportChunk pieces of
+    settings.IMPORT_CHUNK_SIZE characters. Returns the name of the
+    upload and the number of chunks."""
+    upload = "%s-%d" % (str(login_user.key()),int(time.time()*1000))
+    # chunk the characters, not the bytes of the file
+    if isinstance(data, str):
+        data = data.decode('utf-8')
+    chunks = []
+    for n in range(0,len(data),settings.IMPORT_CHUNK_SIZE):
+        chunks.append(ImportChunk(key_name=import_chunk_name(upload,len(chunks)),
+                                  data=db.Text(data[n:n+settings.IMPORT_CHUNK_SIZE])))
+    # a batch put is limited in size, store a few chunks at a time
+    for n in range(0,len(chunks),4):
+        db.put(chunks[n:n+4])
+    return upload,len(chunks)
+
+def read_staged_import(upload, chunks):
+    """Yields the staged pieces of an import file one by one"""
+    for n in range(chunks):
+        chunk = ImportChunk.get_by_key_name(import_chunk_name(upload,n))
+        if not chunk:
+            raise ValueError("Import chunk %d of %s is missing" % (n,upload))
+        yield chunk.data
+
+def parse_import(format, chunks):
+    """Yields the contacts of an import file (a JSON or YAML list) one
+    by one while the file is read piecewise from chunks"""
+    if format == 'JSON':
+        for item in json_list_items(chunks):
+            yield json.loads(item)
+    else:
+        for item in yaml_list_items(chunks):
+            for contact in yaml.load(item) or []:
+                yield contact
+
+def delete_staged_import(upload, chunks):
+    """Removes the staged pieces of an import file"""
+    db.delete([Key.from_path(ImportChunk.kind(), import_chunk_name(upload,n)) for n in range(chunks)])
+
+
+def import_running(job):
+    """True if the import job is still processing. A job which did not
+    finish within settings.IMPORT_TIMEOUT seconds counts as failed."""
+    return job and not job.done and job.started > datetime.datetime.now() - datetime.timedelta(seconds=settings.IMPORT_TIMEOUT)
+
+def start_import(login_user, upload, chunks, format, merge=False):
+    """Replaces the user's import job by a new one for the staged upload
+    and queues its task. A merge import keeps the existing data."""
+    def start():
+        job = ImportJob(key_name=str(login_user.key()), login_user=login_user, upload=upload,
+                        chunks=chunks, format=format, merge=merge, status="Queued import task",
+                        started=datetime.datetime.now())
+        if merge:
+            # nothing to delete
+            job.step = 1
+        job.put()
+        taskqueue.add(url='/import_task', queue_name="import", transactional=True,
+                      params={'login_user': str(login_user.key()), 'upload': upload})
+    db.run_in_transaction(start)
+
+def import_job_status(job):
+    """Returns a line of text about the progress of an import job"""
+    if not job.done and job.batches:
+        return "Importing data: %d contacts in %d of %d batches done." % (
+            get_counter("%s:contacts" % job.upload),len(job.finished),job.batches)
+    if not job.done and not import_running(job):
+        return "Import failed: %s" % (job.status)
+    return job.status
+
+
 class Take2Import(webapp.RequestHandler):
     """Import data into database"""
 
@@ -230,20 +579,26 @@ class Take2Import(webapp.RequestHandler):
             self.redirect('/login')
             return
 
-        if memcache.get('import_status'):
+        if import_running(ImportJob.get_by_key_name(str(login_user.key()))):
             # there is already an import going on
             template_values['errors'] = ["Previous import is still processing. Please be patient..."]
             path = os.path.join(os.path.dirname(__file__), "take2import_file.html")
             self.response.out.write(template.render(path, template_values))
             return
-        memcache.set('import_status', "Queued import task", time=30)
-        memcache.set('import_data', self.request.get("backup"), time=300)
+        try:
+            upload,chunks = stage_import(login_user, self.request.get("backup"))
+        except UnicodeDecodeError:
+            logging.warning("Import file is not UTF-8 encoded.")
+            template_values['errors'] = ["The file is not UTF-8 encoded. Please select a backup file of your address book."]
+            path = os.path.join(os.path.dirname(__file__), "take2import_file.html")
+            self.response.out.write(template.render(path, template_values))
+            return
 
-        logging.info("")
+        logging.info("Import file staged in %d chunks." % (chunks))
 
         # start background process
-        taskqueue.add(url='/import_task', queue_name="import",
-                      params={'login_user': str(login_user.key()), 'format': self.request.get("format", None)})
+        start_import(login_user, upload, chunks, self.request.get("format", None),
+                     merge=bool(self.request.get("merge", None)))
 
         # redirect to page which will show the import progress
         self.redirect('/import_status')
@@ -252,13 +607,20 @@ class Take2ImportStatus(webapp.RequestHandler):
     """Monitor import progress"""
 
     def get(self):
-        """Function displays a simple page to monitor the import progress"""
+        """Function displays a simple page to monitor the import progress
+        (and for the administrator the progress of the background export)"""
         template_values = {}
 
-        status = memcache.get('import_status')
-        if status:
-            template_values['import_status'] = status
-        else:
+        login_user = get_login_user()
+        if login_user:
+            job = ImportJob.get_by_key_name(str(login_user.key()))
+            if job:
+                template_values['import_status'] = import_job_status(job)
+        if users.is_current_user_admin():
+            job = ExportJob.get_by_key_name('export')
+            if job and job.shards:
+                template_values['export_status'] = export_job_status(job, export_shards(job))
+        if not template_values:
             self.redirect('/')
             return
 
@@ -266,181 +628,563 @@ class Take2ImportStatus(webapp.RequestHandler):
         self.response.out.write(template.render(path, template_values))
         return
 
+def counter_key_names(name):
+    """Returns the key names of the CounterShard entities of a counter"""
+    return ["%s:%d" % (name,shard) for shard in range(settings.COUNTER_SHARDS)]
+
+def increment_counter(name, delta=1):
+    """Adds delta to a sharded counter. A random shard is updated, so that
+    parallel tasks rarely update the same entity."""
+    key_name = random.choice(counter_key_names(name))
+    def increment():
+        counter = CounterShard.get_by_key_name(key_name)
+        if not counter:
+            counter = CounterShard(key_name=key_name, name=name)
+        counter.count = counter.count + delta
+        counter.put()
+    db.run_in_transaction(increment)
+
+def get_counter(name):
+    """Returns the value of a sharded counter"""
+    return sum([counter.count for counter in CounterShard.get_by_key_name(counter_key_names(name)) if counter])
+
+def delete_counter(name):
+    """Removes the shards of a counter"""
+    db.delete([Key.from_path(CounterShard.kind(), key_name) for key_name in counter_key_names(name)])
+
+
+def import_contact(contact, login_user, key_name):
+    """Returns a new (not yet stored) Person or Company for a contact
+    from an import file. The fixed key_name makes a repeated import of
+    the contact overwrite the first one."""
+    logging.debug("Import type: %s name: %s id: %s attic: %s" % (contact['type'],
+                   contact['name'] if 'name' in contact else '<no name>',
+                   contact['id'] if 'id' in contact else '<no id>',
+                   contact['attic'] if 'attic' in contact else '<no attic flag>'))
+    if contact['type'] == "person":
+        entry = Person(key_name=key_name, name=contact['name'])
+        if 'lastname' in contact:
+            entry.lastname = lastname=contact['lastname']
+        if 'birthday' in contact:
+            year,month,day = contact['birthday'].split('-')
+            entry.birthday = FuzzyDate(day=int(day),month=int(month),year=int(year))
+        if 'nickname' in contact:
+            entry.nickname = contact['nickname']
+    if contact['type'] == "company":
+        entry = Company(key_name=key_name, name=contact['name'])
+    # importer owns all the data
+    entry.owned_by = login_user
+    if 'attic' in contact:
+        entry.attic = contact['attic']
+    if 'timestamp' in contact:
+        dt,us= contact['timestamp'].split(".")
+        entry.timestamp = datetime.datetime.strptime(dt, "%Y-%m-%dT%H:%M:%S")
+    return entry
+
+def import_take2(contact, entry, key_name, tags, countries):
+    """Returns the new (not yet stored) take2 objects of a contact from an
+    import file and their keys in the import file (None if missing).
+
+    entry is the stored contact. tags and countries are dictionaries
+    which cache OtherTag and Country entities by name. The take2 objects
+    get key names derived from key_name.
+    """
+    take2_entries = []
+    imported_keys = []
+    n = 0
+    for classname in ['email','link','web','address','mobile','other']:
+        if classname in contact:
+            for m in contact[classname]:
+                obj = None
+                obj_key_name = "%s:%03d" % (key_name,n)
+                n = n + 1
+                if classname == 'mobile':
+                    obj = Mobile(key_name=obj_key_name, mobile=m['mobile'], contact_ref=entry)
+                if classname == 'email':
+                    obj = Email(key_name=obj_key_name, email=m['email'], contact_ref=entry)
+                if classname == 'web':
+                    if not m['web'].startswith("http://"):
+                        m['web'] = 'http://'+m['web']
+                    obj = Web(key_name=obj_key_name, web=m['web'], contact_ref=entry)
+                if classname == 'other':
+                    # the export writes the tag name as 'tag'
+                    what = m['what'] if 'what' in m else m['tag']
+                    if what not in tags:
+                        # look for existing tag in DB
+                        tag = OtherTag.all().filter("tag =", what).get()
+                        if not tag:
+                            # a retried import must not add the tag twice
+                            tag = OtherTag.get_or_insert("tag:%s" % (what), tag=what)
+                        tags[what] = tag
+                    obj = Other(key_name=obj_key_name, tag=tags[what], text=m['text'], contact_ref=entry)
+                if classname == 'address':
+                    obj = Address(key_name=obj_key_name, adr=m['adr'], contact_ref=entry)
+                    if 'location_lat' in m and 'location_lon' in m:
+                        obj.location = db.GeoPt(lat=float(m['location_lat']),lon=float(m['location_lon']))
+                    if 'landline_phone' in m:
+                        obj.landline_phone = m['landline_phone']
+                    if 'country' in m and m['country'] != "":
+                        if m['country'] not in countries:
+                            country = Country.all().filter("country =", m['country']).get()
+                            # If country name is not in DB it is added
+                            if not country:
+                                country = Country.get_or_insert("country:%s" % (m['country']), country=m['country'])
+                            countries[m['country']] = country
+                        obj.country = countries[m['country']].key()
+                if obj:
+                    # common fields
+                    if 'timestamp' in m:
+                        dt,us= m['timestamp'].split(".")
+                        obj.timestamp = datetime.datetime.strptime(dt, "%Y-%m-%dT%H:%M:%S")
+                    if 'attic' in m:
+                        obj.attic = m['attic']
+                    take2_entries.append(obj)
+                    imported_keys.append(m.get('key'))
+    return take2_entries,imported_keys
+
+def contact_fields(contact):
+    """Returns the imported fields of a contact for comparison"""
+    birthday = getattr(contact, 'birthday', None)
+    if birthday:
+        birthday = (birthday.year,birthday.month,birthday.day)
+    # the UI stores a missing last name or nickname as ""
+    return (contact.class_name(), contact.name, getattr(contact, 'lastname', None) or "",
+            getattr(contact, 'nickname', None) or "", birthday, contact.attic)
+
+def take2_fields(obj):
+    """Returns the imported fields of a take2 object for comparison"""
+    res = encode_take2_object(obj)
+    for field in ['key','timestamp','attic']:
+        del res[field]
+    return res
+
+def find_contacts(contacts, login_user):
+    """Returns the user's existing contacts which match the contacts from
+    an import file (None if there is no match). A contact is matched by
+    its exported key, else by type and name."""
+    keys = []
+    for contact in contacts:
+        try:
+            key = Key(contact['key']) if 'key' in contact else None
+        except db.BadKeyError:
+            key = None
+        # keys exported from another application cannot be read here
+        if key and key.app() != login_user.key().app():
+            key = None
+        keys.append(key)
+    by_key = {}
+    for con in db.get([key for key in keys if key]):
+        if con and isinstance(con, Contact) and Contact.owned_by.get_value_for_datastore(con) == login_user.key():
+            by_key[con.key()] = con
+    res = []
+    for contact,key in zip(contacts,keys):
+        if key in by_key:
+            res.append(by_key[key])
+            continue
+        if contact['type'] == "person":
+            query = Person.all()
+            lastname = contact.get('lastname', None)
+            if lastname:
+                query.filter("lastname =", lastname)
+            else:
+                # the UI stores a missing last name as "", older imports as None
+                query.filter("lastname IN", ["", None])
+        else:
+            query = Company.all()
+        query.filter("owned_by =", login_user)
+        query.filter("name =", contact['name'])
+        res.append(query.get())
+    return res
+
+
+def import_batch_name(upload, batch):
+    """Returns the key name of an ImportBatch"""
+    return "%s:%05d" % (upload,batch)
+
+def update_import_job(login_user, upload, update):
+    """Changes the user's ImportJob in a transaction. update is called
+    with the job and returns False if nothing has to be stored. When the
+    last batch is done (and the upload is split), the link pass (see
+    Take2ImportLinks) is queued in the same transaction, so it is queued
+    exactly once."""
+    def txn():
+        job = ImportJob.get_by_key_name(str(login_user.key()))
+        if not job or job.upload != upload:
+            return None
+        complete = job.step == 2 and len(job.finished) >= job.batches
+        if update(job) is False:
+            return job
+        job.put()
+        if not complete and job.step == 2 and len(job.finished) >= job.batches:
+            taskqueue.add(url='/import_links', queue_name="import", transactional=True,
+                          params={'login_user': str(login_user.key()), 'upload': upload})
+        return job
+    return db.run_in_transaction(txn)
+
+def finish_import_batch(login_user, batch):
+    """Records a done batch in the ImportJob. Repeated calls for the same
+    batch change nothing."""
+    def finish(job):
+        if batch.number in job.finished:
+            return False
+        job.finished.append(batch.number)
+    update_import_job(login_user, batch.upload, finish)
+
+
 class Take2ImportTask(webapp.RequestHandler):
     """Used by task queue"""
 
     def post(self):
-        """Function is called asynchronously to import data sets to the DB and
-        delete existing data.
+        """Function is called asynchronously to delete existing data and
+        to split the import data into batches of settings.IMPORT_BATCH_SIZE
+        contacts. Every batch is imported by its own task (see
+        Take2ImportBatch).
+
+        The progress is checkpointed in the ImportJob (step 0: delete,
+        step 1: split, step 2: done). A retried task continues after the
+        last queued batch.
         """
 
         login_user = LoginUser.get(self.request.get("login_user", None))
+        upload = self.request.get("upload")
 
-        status = memcache.get('import_status')
-        if not status:
-            logging.critical("Failed to retrieve import status from memcache.")
+        job = ImportJob.get_by_key_name(str(login_user.key()))
+        if not job or job.upload != upload:
+            logging.critical("Import job for upload %s not found." % (upload))
             self.error(500)
             return
 
-        data = memcache.get('import_data')
-        if not data:
-            logging.critical("Failed to retrieve import data from memcache.")
-            self.error(500)
-            return
+        chunks = job.chunks
+        logging.info("Import %d chunks for processing (step %d). user=%s" % (chunks,job.step,login_user.me.name) )
 
-        logging.info("Retrieved %d bytes for processing. user=%s" % (len(data),login_user.me.name) )
-        memcache.set('import_status', "Parsing import data.", time=10)
+        if job.step == 0:
+            # purge DB page by page, a retry continues at the checkpointed cursor
+            logging.info("Import task starts deleting data...")
+            while True:
+                query = db.Query(Contact,keys_only=True)
+                query.filter("owned_by =", login_user)
+                if job.cursor:
+                    query.with_cursor(job.cursor)
+                keys = query.fetch(settings.IMPORT_BATCH_SIZE)
+                # delete all dependent data (the datastore allows up to 30 values for IN)
+                for n in range(0,len(keys),30):
+                    q_t = db.Query(Take2,keys_only=True)
+                    q_t.filter("contact_ref IN", keys[n:n+30])
+                    db.delete(list(q_t))
+                delete_index(keys)
+                # except the one which is the login_user's Person
+                db.delete([key for key in keys if key != login_user.me.key()])
+                job = self.update(login_user, upload, cursor=query.cursor(), deleted=job.deleted+len(keys),
+                                  status="Deleting data: %d deleted." % (job.deleted+len(keys)))
+                if not job:
+                    return
+                if len(keys) < settings.IMPORT_BATCH_SIZE:
+                    break
+            logging.info("Import task deleted %d contact datasets" % (job.deleted))
+            job = self.update(login_user, upload, step=1)
+            if not job:
+                return
 
-        format=self.request.get("format", None)
-        if format == 'JSON':
-            dbdump = json.loads(data)
+        if job.step == 1:
+            # the file is parsed piecewise while the contacts are split into batches
+            dbdump = parse_import(job.format, read_staged_import(upload, chunks))
+            batches = job.position / settings.IMPORT_BATCH_SIZE
+            contacts = []
+            index = 0
+            for contact in dbdump:
+                index = index + 1
+                # skip the contacts of the batches queued by a previous attempt
+                if index <= job.position:
+                    continue
+                contacts.append(contact)
+                if len(contacts) == settings.IMPORT_BATCH_SIZE:
+                    self.queue_batch(login_user, upload, batches, contacts)
+                    batches = batches + 1
+                    contacts = []
+                    self.update(login_user, upload, position=index,
+                                status="Importing data: %d batches queued." % (batches))
+            if contacts:
+                self.queue_batch(login_user, upload, batches, contacts)
+                batches = batches + 1
+            logging.info("Import split into %d batches." % (batches))
+            self.update(login_user, upload, position=index, batches=batches, step=2)
+            delete_staged_import(upload, chunks)
+
+    def update(self, login_user, upload, **values):
+        """Stores properties of the ImportJob. Batch tasks change the job
+        at the same time, so it is read again in a transaction."""
+        def set_values(job):
+            for name,value in values.items():
+                setattr(job, name, value)
+        return update_import_job(login_user, upload, set_values)
+
+    def queue_batch(self, login_user, upload, batch, contacts):
+        """Stores a batch of contacts and queues the task which imports it.
+        A batch which was stored by a previous attempt is left alone."""
+        name = import_batch_name(upload,batch)
+        def queue():
+            if ImportBatch.get_by_key_name(name):
+                return
+            ImportBatch(key_name=name, upload=upload, number=batch, data=db.Text(json.dumps(contacts))).put()
+            taskqueue.add(url='/import_batch', queue_name="import", transactional=True,
+                          params={'login_user': str(login_user.key()), 'batch': name})
+        db.run_in_transaction(queue)
+
+
+class Take2ImportBatch(webapp.RequestHandler):
+    """Used by task queue (queued by Take2ImportTask)"""
+
+    def post(self):
+        """Imports a batch of contacts and their take2 objects with one
+        batch put each. The references between the contacts are resolved
+        by Take2ImportLinks once all batches are done.
+
+        All new entities get key names derived from the batch, so a retry
+        overwrites what a failed attempt stored. The batch is recorded as
+        done in the ImportJob after it is stored; a retry only repeats
+        that step.
+        """
+        login_user = LoginUser.get(self.request.get("login_user", None))
+        batch = ImportBatch.get_by_key_name(self.request.get("batch"))
+        if not batch:
+            logging.warning("Import batch %s not found." % (self.request.get("batch")))
+            return
+        if batch.done:
+            logging.info("Import batch %s is already done." % (batch.key().name()))
+            finish_import_batch(login_user, batch)
+            return
+        job = ImportJob.get_by_key_name(str(login_user.key()))
+        if not job or job.upload != batch.upload:
+            # the job was replaced by a newer import
+            logging.warning("Import batch %s is outdated." % (batch.key().name()))
+            batch.delete()
+            return
+
+        contacts = json.loads(batch.data)
+        key_names = ["%s:%03d" % (batch.key().name(),n) for n in range(len(contacts))]
+        entries = [import_contact(contact, login_user, key_name)
+                   for contact,key_name in zip(contacts,key_names)]
+        if job.merge:
+            entries = self.merge(batch, login_user, contacts, key_names, entries)
         else:
-            dbdump = yaml.load(data)
+            db.put(entries)
+            tags = {}
+            countries = {}
+            take2_entries = []
+            for contact,entry,key_name in zip(contacts,entries,key_names):
+                objs,imported_keys = import_take2(contact, entry, key_name, tags, countries)
+                for obj in objs:
+                    # candidate for the LoginUser's own Person
+                    if obj.class_name() == "Email" and obj.email == login_user.user.email():
+                        batch.me.append(str(entry.key()))
+                take2_entries.extend(objs)
+            db.put(take2_entries)
+            # the previous index of the user was deleted (step 0 of Take2ImportTask)
+            index = []
+            for obj in entries + take2_entries:
+                index.extend(update_index(obj, batch=True) or [])
+            store_index_update(index)
+            # sync clients read take2 changes from the change log
+            db.put([entry for entry in [change_entry(obj, 'put', obj.contact_ref) for obj in take2_entries] if entry])
+            batch.inserted = len(entries) + len(take2_entries)
+            logging.info("Import batch %s added %d contacts and %d dependent datasets" % (batch.key().name(),len(entries),len(take2_entries)))
 
-        # purge DB
-        logging.info("Import task starts deleting data...")
-        contact_entries = db.Query(Contact,keys_only=True)
-        contact_entries.filter("owned_by =", login_user)
-        count = 0
-        delete_contacts = []
-        for c in contact_entries:
-            # delete all dependent data
-            q_t = db.Query(Take2,keys_only=True)
-            q_t.filter("contact_ref =", c)
-            db.delete(q_t)
-            q_i = db.Query(Search,keys_only=True)
-            q_i.filter("contact_ref =", c)
-            db.delete(q_i)
-            count = count +1
-            memcache.set('import_status', "Deleting data: %d deleted." % (count), time=3)
-            # remember for bulk delete except the one which is the login_user's Person
-            if c != login_user.me:
-                delete_contacts.append(c)
-        db.delete(delete_contacts)
-        logging.info("Import task deleted %d contact datasets" % (count))
-
-        # dictionary will be filled with a reference to the freshly created person
-        # key using the former key as stored in the dbdump. Needed later for resolving
-        # the owned by references.
-        old_key_to_new_key = {}
-        link_to_references = []
-        take2_entries = []
-        count = 0.0
-        for contact in dbdump:
-            memcache.set('import_status', "Importing data: %3.0f%% done." % ((count/len(dbdump))*100.0), time=3)
-            logging.debug("Import type: %s name: %s id: %s attic: %s" % (contact['type'],
-                           contact['name'] if 'name' in contact else '<no name>',
-                           contact['id'] if 'id' in contact else '<no id>',
-                           contact['attic'] if 'attic' in contact else '<no attic flag>'))
-            if contact['type'] == "person":
-                entry = Person(name=contact['name'])
-                if 'lastname' in contact:
-                    entry.lastname = lastname=contact['lastname']
-                if 'birthday' in contact:
-                    year,month,day = contact['birthday'].split('-')
-                    entry.birthday = FuzzyDate(day=int(day),month=int(month),year=int(year))
-                if 'nickname' in contact:
-                    entry.nickname = contact['nickname']
-            if contact['type'] == "company":
-                entry = Company(name=contact['name'])
-            # importer owns all the data
-            entry.owned_by = login_user
-            if 'attic' in contact:
-                entry.attic = contact['attic']
-            if 'timestamp' in contact:
-                dt,us= contact['timestamp'].split(".")
-                entry.timestamp = datetime.datetime.strptime(dt, "%Y-%m-%dT%H:%M:%S")
-            entry.put()
+        for contact,entry in zip(contacts,entries):
             # remember the key from the imported file for later dependency resolve
             if 'key' in contact:
-                old_key_to_new_key[contact['key']] = entry.key()
-            count = count+1
-
-            # check for all take2 objects
-            for classname in ['email','link','web','address','mobile','other']:
-                if classname in contact:
-                    for m in contact[classname]:
-                        obj = None
-                        if classname == 'mobile':
-                            obj = Mobile(mobile=m['mobile'], contact_ref=entry)
-                        if classname == 'email':
-                            obj = Email(email=m['email'], contact_ref=entry)
-                        if classname == 'web':
-                            if not m['web'].startswith("http://"):
-                                m['web'] = 'http://'+m['web']
-                            obj = Web(web=m['web'], contact_ref=entry)
-                        if classname == 'other':
-                            # look for existing tag in DB
-                            tag = OtherTag.all().filter("tag =", m['what']).get()
-                            if not tag:
-                                tag = OtherTag(tag=m['what'])
-                                tag.put()
-                            obj = Other(tag=tag, text=m['text'], contact_ref=entry)
-                        if classname == 'link':
-                            # save the link_to key from the imported data in the link_to
-                            # property for rater resolve
-                            link_to_references.append((entry.key(),m['link_to']))
-                        if classname == 'address':
-                            obj = Address(adr=m['adr'], contact_ref=entry)
-                            if 'location_lat' in m and 'location_lon' in m:
-                                obj.location = db.GeoPt(lat=float(m['location_lat']),lon=float(m['location_lon']))
-                            if 'landline_phone' in m:
-                                obj.landline_phone = m['landline_phone']
-                            if 'country' in m and m['country'] != "":
-                                country = Country.all().filter("country =", m['country']).get()
-                                # If country name is not in DB it is added
-                                if not country:
-                                    country = Country(country=m['country'])
-                                    country.put()
-                                obj.country = country.key()
-                        if obj:
-                            # common fields
-                            if 'timestamp' in m:
-                                dt,us= m['timestamp'].split(".")
-                                obj.timestamp = datetime.datetime.strptime(dt, "%Y-%m-%dT%H:%M:%S")
-                            if 'attic' in m:
-                                obj.attic = m['attic']
-                            take2_entries.append(obj)
-
-        memcache.set('import_status', "Store dependent entries.", time=30)
+                batch.key_map.append("%s %s" % (contact['key'],str(entry.key())))
+            # save the link_to key from the imported data for later resolve
+            for m in contact.get('link', []):
+                batch.links.append("%s %s" % (str(entry.key()),m['link_to']))
+
+        batch.count = len(entries)
+        batch.done = True
+        batch.data = None
+        batch.put()
+        # the counter only shows the progress, a retry may count twice
+        increment_counter("%s:contacts" % batch.upload, len(entries))
+        finish_import_batch(login_user, batch)
+
+    def merge(self, batch, login_user, contacts, key_names, entries):
+        """Merges a batch of contacts into the user's existing data and
+        returns the contacts in the database. Only datasets which are new,
+        or which are newer in the import file and differ, are written. A
+        changed take2 object is stored as a new version and the old one
+        is moved to the attic. The numbers of inserted, updated and
+        unchanged datasets are recorded in the batch.
+        """
+        existing = find_contacts(contacts, login_user)
+        take2 = prefetch_take2([con for con in existing if con], include_attic=True)
+
+        res = []
+        changed = []
+        for entry,con in zip(entries,existing):
+            if not con:
+                res.append(entry)
+                changed.append(entry)
+                batch.inserted = batch.inserted + 1
+            elif ((not entry.timestamp or entry.timestamp > con.timestamp) and
+                  entry.class_name() == con.class_name() and contact_fields(entry) != contact_fields(con)):
+                con.name = entry.name
+                con.attic = entry.attic
+                if con.class_name() == "Person":
+                    con.lastname = entry.lastname or ""
+                    con.nickname = entry.nickname or ""
+                    con.birthday = entry.birthday
+                res.append(con)
+                changed.append(con)
+                batch.updated = batch.updated + 1
+            else:
+                res.append(con)
+                batch.unchanged = batch.unchanged + 1
+        db.put(changed)
+
+        # the changes are logged with one put
+        changes = [(con,'put',None) for con in changed]
+        tags = {}
+        countries = {}
+        take2_entries = []
+        for contact,con,key_name in zip(contacts,res,key_names):
+            objs,imported_keys = import_take2(contact, con, key_name, tags, countries)
+            candidates = take2.get(con.key(), [])
+            for obj,imported_key in zip(objs,imported_keys):
+                # match by exported key, else by the same data
+                match = None
+                for old in candidates:
+                    if str(old.key()) == imported_key:
+                        match = old
+                        break
+                if not match:
+                    for old in candidates:
+                        if old.class_name() == obj.class_name() and take2_fields(old) == take2_fields(obj):
+                            match = old
+                            break
+                if not match:
+                    take2_entries.append(obj)
+                    changes.append((obj,'put',con))
+                    batch.inserted = batch.inserted + 1
+                    continue
+                newer = not obj.timestamp or obj.timestamp > match.timestamp
+                if newer and take2_fields(match) != take2_fields(obj):
+                    # store the new version and archive the old one
+                    match.attic = True
+                    take2_entries.extend([match,obj])
+                    changes.extend([(match,'attic',con),(obj,'put',con)])
+                    batch.updated = batch.updated + 1
+                elif newer and match.attic != obj.attic:
+                    match.attic = obj.attic
+                    take2_entries.append(match)
+                    changes.append((match,'attic' if match.attic else 'deattic',con))
+                    batch.updated = batch.updated + 1
+                else:
+                    batch.unchanged = batch.unchanged + 1
+        db.put(take2_entries)
+        db.put([entry for entry in [change_entry(obj, operation, contact) for obj,operation,contact in changes] if entry])
+        # new and changed datasets must be found by search, archived ones no longer
+        for obj,operation,contact in changes:
+            schedule_index_update(obj)
+        logging.info("Import batch %s merged: %d inserted, %d updated, %d unchanged" % (batch.key().name(),
+                     batch.inserted,batch.updated,batch.unchanged))
+        return res
+
+
+class Take2ImportLinks(webapp.RequestHandler):
+    """Used by task queue (queued by update_import_job)"""
+
+    def post(self):
+        """Resolves the references between the imported contacts and the
+        LoginUser's own Person after all batches of an import are done"""
+        login_user = LoginUser.get(self.request.get("login_user", None))
+        upload = self.request.get("upload")
+
+        job = ImportJob.get_by_key_name(str(login_user.key()))
+        if not job or job.upload != upload:
+            logging.critical("Import job for upload %s not found." % (upload))
+            self.error(500)
+            return
+        batch_keys = [Key.from_path(ImportBatch.kind(), import_batch_name(upload,n)) for n in range(job.batches)]
+        if job.done:
+            # a previous attempt failed while cleaning up
+            self.cleanup(upload, batch_keys)
+            return
+
+        batches = db.get(batch_keys)
+        if None in batches or [batch for batch in batches if not batch.done]:
+            logging.critical("Import of %s: batches are missing." % (upload))
+            return
+
+        old_key_to_new_key = {}
+        link_to_references = []
+        me = []
+        for batch in batches:
+            for pair in batch.key_map:
+                old_key,new_key = pair.split(" ")
+                old_key_to_new_key[old_key] = Key(new_key)
+            for pair in batch.links:
+                parent,child_old_key = pair.split(" ")
+                link_to_references.append((Key(parent),child_old_key))
+            me.extend(batch.me)
 
         #
         # Resolve (if possible) the reference of the LoginUser to his/her own Person entry
         #
-        for t2 in take2_entries:
-            if t2.class_name() == "Email":
-                if t2.email == login_user.user.email():
-                    # throw away existing login_user Person
-                    login_user.me.delete()
-                    login_user.put()
-                    login_user.me = t2.contact_ref
-                    login_user.put()
-                    logging.info("Resolved LoginUsers Person: %s using email: %s" % (t2.contact_ref.name, t2.email))
+        if me and login_user.me.key() != Key(me[0]) and not job.merge:
+            # throw away existing login_user Person
+            login_user.me.delete()
+            login_user.me = Key(me[0])
+            login_user.put()
+            logging.info("Resolved LoginUsers Person: %s" % (me[0]))
 
         #
         # Back references to people
         #
+        children = {}
         for parent,child_old_key in link_to_references:
             # find child's new key
-            key = old_key_to_new_key[child_old_key]
-            # update child with back reference
-            child = Contact.get(key)
-            child.middleman_ref = parent
-            child.put()
+            if child_old_key in old_key_to_new_key:
+                children[old_key_to_new_key[child_old_key]] = parent
+        keys = children.keys()
+        updated = []
+        for child in db.get(keys):
+            if child and Contact.middleman_ref.get_value_for_datastore(child) != children[child.key()]:
+                # update child with back reference
+                child.middleman_ref = children[child.key()]
+                updated.append(child)
+        db.put(updated)
 
-        #
-        # Bulk store new entries
-        #
-        logging.info("Import task added %d contacts. Now store their %d dependent datasets" % (count,len(take2_entries)))
-        db.put(take2_entries)
+        job.inserted = sum([batch.inserted for batch in batches])
+        job.updated = sum([batch.updated for batch in batches])
+        job.unchanged = sum([batch.unchanged for batch in batches])
+        if job.merge:
+            job.status = "Merge done: %d inserted, %d updated, %d unchanged." % (job.inserted,job.updated,job.unchanged)
+        else:
+            job.status = "Import done: %d contacts." % (sum([batch.count for batch in batches]))
+        job.done = True
+        job.put()
+        self.cleanup(upload, batch_keys)
         logging.info("Import task done.")
-        # make sure that all indices have to be re-built
-        memcache.flush_all()
+        # drop the cached data of the user (the index was updated by the batches)
+        namespace = str(login_user.key())
+        memcache.delete_multi(['birthdays','location','visible','query'], namespace=namespace)
+        memcache.incr('lookup_generation', namespace=namespace, initial_value=lookup_cache_seed())
+
+    def cleanup(self, upload, batch_keys):
+        """Removes the batches and counters of a finished import"""
+        db.delete(batch_keys)
+        delete_counter("%s:contacts" % (upload))
+
 
 application = webapp.WSGIApplication([('/importfile', Take2Import),
                                       ('/import', Take2SelectImportFile),
                                       ('/import_status', Take2ImportStatus),
                                       ('/import_task', Take2ImportTask),
+                                      ('/import_batch', Take2ImportBatch),
+                                      ('/import_links', Take2ImportLinks),
+                                      ('/export_job', Take2ExportJob),
+                                      ('/export_task', Take2ExportTask),
+                                      ('/export_gc', CollectExportGarbage),
+                                      ('/export_manifest', Take2ExportManifest),
+                                      ('/export_chunk', Take2ExportChunk),
                                       ('/export.*', Take2Export),
                                      ],settings.DEBUG)
 
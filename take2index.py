@@ -8,7 +8,9 @@ import settings
 import logging
 import os
 from django.utils import simplejson as json
-import unicodedata
+import hashlib
+import re
+import time
 from random import shuffle
 from datetime import datetime
 from google.appengine.ext import db
@@ -17,47 +19,169 @@ from google.appengine.ext import webapp
 from google.appengine.ext.db import Key
 from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from take2dbm import Contact, Person, Company, Take2, SearchIndex, Address, GeoIndex, LoginUser
+from take2dbm import IndexJob, IndexGeneration, PrefixBucket, FixReport
+from take2text import plainify, trigrams, trigram_similarity, cologne_phonetic
 
-def plainify(string):
-    """Removes all accents and special characters form string and converts
-    string to lower case. If the string is made up of several words a list
-    of these words is returned.
+def field_tokens(field, words):
+    """Returns the index keywords for words found in a field (e.g. email)
 
-    Returns an array of plainified strings (splitted at space)
+    Field keywords are tagged ('#email:gmail') so that they are only found
+    by field qualified searches (see field_query) and never show up in the
+    autocompletion.
     """
-    res = []
-    for s1 in string.split(" "):
-        s1 = s1.strip(",.;:\\?/!@#$%^&*()[]{}|\"'")
-        s1 = unicode(s1)
-        s1 = unicodedata.normalize('NFD',s1.lower())
-        s1 = s1.replace("`", "")
-        s1 = s1.encode('ascii','ignore')
-        s1 = s1.replace("~", "")
-        s1 = s1.strip()
-        if len(s1):
-            res.append(s1)
+    return ["#%s:%s" % (field,word) for word in words if word]
 
-    return res
+
+def phone_digits(number):
+    """Returns only the digits of a phone number"""
+    return "".join([c for c in number if c.isdigit()])
+
+
+def phone_tokens(number):
+    """Index keywords for a phone number: all its digit suffixes, so that
+    a prefix search finds any fragment of the number"""
+    digits = phone_digits(number)
+    return field_tokens('phone', [digits[n:] for n in range(len(digits)-settings.PHONE_FRAGMENT_LENGTH+1)])
+
+
+def email_tokens(obj):
+    """Index keywords for an Email: the address, its domain and the words in it"""
+    if not obj.email:
+        return []
+    address = plainify(obj.email)
+    words = set(address)
+    for word in address:
+        words.add(word.partition("@")[2])
+        words.update(re.split(r"[@.+_-]", word))
+    return field_tokens('email', words)
+
+
+def mobile_tokens(obj):
+    """Index keywords for a Mobile"""
+    return phone_tokens(obj.mobile)
+
+
+def web_tokens(obj):
+    """Index keywords for a Web site: the host and the words in the link"""
+    link = re.sub(r"^[a-z]+://", "", obj.web.lower())
+    words = set(plainify(link.partition("/")[0]))
+    words.update(plainify(re.sub(r"[/.:?=&_-]", " ", link)))
+    return field_tokens('web', words)
+
+
+def other_tokens(obj):
+    """Index keywords for the text of an Other"""
+    if not obj.text:
+        return []
+    return field_tokens('other', set(plainify(obj.text)))
+
+
+def address_tokens(obj):
+    """Index keywords for all lines of an Address and its landline phone"""
+    words = set()
+    for line in obj.adr:
+        words.update(plainify(line))
+    tokens = field_tokens('address', words)
+    if obj.landline_phone:
+        tokens.extend(phone_tokens(obj.landline_phone))
+    return tokens
+
+
+# Index keyword extractors for the Take2 classes. An extractor returns
+# the field keywords for an entity, a new class is indexed by adding it here.
+INDEX_EXTRACTORS = {'Email': email_tokens,
+                    'Mobile': mobile_tokens,
+                    'Web': web_tokens,
+                    'Other': other_tokens,
+                    'Address': address_tokens}
+
+# fields which can be searched with a qualifier (e.g. phone:0171)
+SEARCH_FIELDS = ['email','phone','web','other','address']
+
+def field_query(query):
+    """Translates a field qualified search term ('email:gmail') into a
+    prefix of the tagged index keywords (see field_tokens). Other terms
+    are returned as they are."""
+    field,sep,value = query.partition(":")
+    if not sep or field not in SEARCH_FIELDS:
+        return query
+    if field == 'phone':
+        value = phone_digits(value)
+    return "#%s:%s" % (field,value)
+
+
+def is_field_query(query):
+    """True for a translated field search term (see field_query)"""
+    return query.startswith("#")
+
+
+def index_key_name(data_key, generation=0):
+    """Returns the key name of the SearchIndex and GeoIndex entries
+    which index the dataset with key data_key in an index generation"""
+    if generation:
+        return "%d:%s" % (generation,str(data_key))
+    return str(data_key)
+
+
+def index_generations():
+    """Returns the current index generation and the generation which
+    is being built (None if there is no rebuild running) as a tuple.
+
+    The IndexGeneration pointer is cached in memcache.
+    """
+    generations = memcache.get('index_generation')
+    if generations is None:
+        pointer = IndexGeneration.get_by_key_name('index')
+        if pointer:
+            generations = (pointer.current,pointer.building)
+        else:
+            generations = (0,None)
+        memcache.set('index_generation', generations, time=settings.INDEX_GENERATION_CACHE_TIME)
+    return generations
+
+
+def current_generation():
+    """Returns the index generation which is used for searches"""
+    return index_generations()[0]
+
+
+def live_generations():
+    """Returns the index generations which have to be kept up to date"""
+    current,building = index_generations()
+    if building is None:
+        return [current]
+    return [current,building]
 
 
-def update_index(obj, batch=False):
+def update_index(obj, batch=False, generations=None):
     """Updates SearchIndex and GeoIndex tables with obj-related keywords
     and locations for the contact to which obj belongs.
 
     If obj indices are already in the SearchIndex, their content is updated.
     If obj is new, it is added.
+    If batch is set, nothing is stored. The index entities are returned
+    for a bulk store_index_update() instead.
+    The entries are written for the given index generations, by default
+    for the current generation and a generation which is being built.
+    Index entries are tagged with the contact's owner (owned_by) so that
+    searches can be restricted to one address book.
 
     Index keywords are:
     - name       (name: Contact)
     - nickname   (nickname: Person)
     - last name  (lastname: Person)
     - place      (adr_zoom: Address)
+    Names are also indexed by their phonetic code (see cologne_phonetic).
+    Take2 entities add the field keywords of their INDEX_EXTRACTORS
+    (email, phone, web, other and address).
     """
     #
     # generate the keys and find the contact reference
     #
     new_keys = None
+    new_phonetic = None
     new_location = None
     contact_ref = None
     attic = False
@@ -75,6 +199,7 @@ def update_index(obj, batch=False):
                 new_keys.extend(plainify(contact.lastname))
             if contact.nickname:
                 new_keys.extend(plainify(contact.nickname))
+        new_phonetic = [cologne_phonetic(key) for key in new_keys]
         attic = obj.attic or contact.attic
     elif obj_class in ['Address']:
         try:
@@ -84,9 +209,18 @@ def update_index(obj, batch=False):
             return None
         # use the elements as search keys (should be town and neighborhood or similar)
         new_keys = plainify(" ".join(obj.adr_zoom[:2]))
+        new_keys.extend(INDEX_EXTRACTORS[obj_class](obj))
         if obj.location:
             new_location = obj.location
         attic = obj.attic or contact.attic
+    elif obj_class in INDEX_EXTRACTORS:
+        try:
+            contact = obj.contact_ref
+        except db.ReferencePropertyResolveError:
+            logging.warning("%s has invalid reference to contact %s" % (obj_class,str(obj.key())))
+            return None
+        new_keys = INDEX_EXTRACTORS[obj_class](obj)
+        attic = obj.attic or contact.attic
     elif obj_class in ['LoginUser']:
         try:
             contact = obj.me
@@ -104,70 +238,515 @@ def update_index(obj, batch=False):
     if new_keys:
         logging.debug("Update %s class %s with keys: %s" % (contact.name,obj_class,new_keys))
 
-    if new_keys:
-        # read SearchIndex dataset with reference to obj
-        data = SearchIndex.all().filter("data_ref =", obj).get()
-        if data:
-            # update existing dataset
-            data.keys = new_keys
-            data.attic = attic
-        else:
-            if batch:
-                logging.warning("A new search index was created in batch for dataset: %d" % (obj.key().id()))
-            data = SearchIndex(keys=new_keys, attic=attic,
-                                data_ref=obj, contact_ref=contact)
-        if batch:
+    # the owner key is read without dereferencing the LoginUser
+    owned_by = Contact.owned_by.get_value_for_datastore(contact)
+
+    if generations is None:
+        generations = live_generations()
+
+    for generation in generations:
+        # Index entities are keyed by their data_ref. A put overwrites the
+        # previous version of the index entry, no lookup is needed.
+        key_name = index_key_name(obj.key(), generation)
+        if new_keys:
+            data = SearchIndex(key_name=key_name, keys=new_keys, attic=attic,
+                               data_ref=obj, contact_ref=contact, owned_by=owned_by,
+                               generation=generation)
+            if settings.TRIGRAM_INDEX:
+                grams = set()
+                for key in new_keys:
+                    if not is_field_query(key):
+                        grams.update(trigrams(key))
+                data.grams = list(grams)
+            if new_phonetic:
+                data.phonetic = list(set([code for code in new_phonetic if code]))
             res.append(data)
-        else:
-            data.put()
 
-    if new_location:
-        # read GeoIndex dataset with reference to obj
-        geo = GeoIndex.all().filter("data_ref =", obj).get()
-        if geo:
-            # update existing dataset
-            geo.location = new_location
-            geo.attic = attic
+        if new_location:
+            geo = GeoIndex(key_name=key_name, location=new_location, attic=attic,
+                           data_ref=obj, contact_ref=contact, owned_by=owned_by,
+                           generation=generation)
             # update geo reference field
             geo.update_location()
-        else:
-            if batch:
-                logging.warning("A new geo index was created in batch for dataset: %d" % (obj.key().id()))
-            geo = GeoIndex(location=new_location, attic=attic,
-                           data_ref=obj, contact_ref=contact)
-            geo.update_location()
-        if batch:
             res.append(geo)
-        else:
-            geo.put()
+
+    if not batch:
+        store_index_update(res)
 
     return res
 
+
+def schedule_index_update(obj):
+    """Queues an update of the index entries of obj after it was saved
+
+    The update is done in the background by IndexWorker, which collects
+    the updates of settings.INDEX_WORKER_INTERVAL seconds. As long as an
+    update of obj is waiting, no other one is queued. Without
+    settings.INDEX_WRITE_BEHIND the index is updated right away.
+    """
+    if not settings.INDEX_WRITE_BEHIND:
+        update_index(obj)
+        return
+    key = str(obj.key())
+    if not memcache.add(key, 1, time=settings.INDEX_LEASE_TIME*10, namespace='index_pending'):
+        # an update is already waiting
+        return
+    payload = json.dumps({'key': key, 'queued': time.time()})
+    taskqueue.Queue('index-pending').add(taskqueue.Task(payload=payload, method='PULL'))
+    # one worker task per interval (task names are unique)
+    interval = int(time.time() / settings.INDEX_WORKER_INTERVAL)
+    try:
+        taskqueue.add(url='/index_worker', queue_name="index", name="index-worker-%d" % (interval),
+                      countdown=settings.INDEX_WORKER_INTERVAL)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def prefix_bucket_parent(generation, owned_by):
+    """Returns the (entity group) parent key of a user's PrefixBuckets of
+    one index generation. owned_by is a key."""
+    return Key.from_path('PrefixBuckets', "%d:%s" % (generation,str(owned_by)))
+
+
+def store_index_update(entities, delete=False):
+    """Stores index entities (e.g. the result of update_index), or
+    deletes them if delete is set.
+
+    SearchIndex entries of a user are written together with the changes
+    of the autocompletion keywords (see store_search_entries). Cached
+    search results of the users whose part of the current index changes
+    are invalidated after the write, so that no lookup caches the old
+    entries again.
+    """
+    entries = []
+    others = []
+    for entity in entities:
+        if isinstance(entity, SearchIndex) and SearchIndex.owned_by.get_value_for_datastore(entity):
+            entries.append(entity)
+        else:
+            others.append(entity)
+    store_search_entries(entries, delete)
+    if delete:
+        db.delete(others)
+    else:
+        db.put(others)
+    current = current_generation()
+    owners = set()
+    for entry in entities:
+        if isinstance(entry, SearchIndex) and entry.generation == current:
+            owners.add(SearchIndex.owned_by.get_value_for_datastore(entry))
+    if owners:
+        # anonymous searches cover all users
+        owners.add(None)
+        for owned_by in owners:
+            memcache.incr('lookup_generation', namespace=str(owned_by) if owned_by else None,
+                          initial_value=lookup_cache_seed())
+
+
+def delete_index(contact_keys):
+    """Removes the SearchIndex and GeoIndex entries of contacts (and of
+    their take2 data). The autocompletion keywords and cached search
+    results are updated like for an index update.
+    """
+    # the datastore allows up to 30 values for IN
+    for n in range(0,len(contact_keys),30):
+        entries = list(SearchIndex.all().filter("contact_ref IN", contact_keys[n:n+30]))
+        for entry in entries:
+            # counted like an archived entry
+            entry.attic = True
+        store_index_update(entries, delete=True)
+        db.delete(list(GeoIndex.all(keys_only=True).filter("contact_ref IN", contact_keys[n:n+30])))
+
+
+def lookup_cache_seed():
+    """Initial value for a lookup cache generation counter. It must not
+    repeat a value used before the counter was evicted from memcache."""
+    return int(time.time()*1000)
+
+
+def lookup_cache_key(queries, include_attic=False, owned_by=None, phonetic=False):
+    """Returns the memcache key (in the namespace of user owned_by) for
+    the result of a lookup_contacts search for the plainified queries
+
+    The key contains the index generation and the user's lookup cache
+    generation, which is incremented whenever the user's index changes.
+    """
+    namespace = str(owned_by.key()) if owned_by else None
+    lookup_generation = memcache.get('lookup_generation', namespace=namespace)
+    if lookup_generation is None:
+        lookup_generation = lookup_cache_seed()
+        if not memcache.add('lookup_generation', lookup_generation, namespace=namespace):
+            lookup_generation = memcache.get('lookup_generation', namespace=namespace)
+    terms = " ".join(sorted(set(queries)))
+    return "lookup:%d:%s:%s:%d:%d" % (current_generation(),lookup_generation,
+                                      hashlib.md5(terms).hexdigest(),include_attic,phonetic)
+
+
+def store_search_entries(entries, delete=False):
+    """Stores (or deletes) SearchIndex entries of users and updates the
+    autocompletion keywords (PrefixBucket) of their owners.
+
+    A user's buckets of an index generation form one entity group. The
+    entries are written with the bucket changes in cross-group
+    transactions, so that a retried update is not counted twice.
+    """
+    groups = {}
+    for entry in entries:
+        owned_by = SearchIndex.owned_by.get_value_for_datastore(entry)
+        groups.setdefault((entry.generation,owned_by),[]).append(entry)
+
+    # cached keywords per user namespace
+    outdated = {}
+    options = db.create_transaction_options(xg=True)
+    for (generation,owned_by),group in groups.items():
+        # a transaction spans up to 25 entity groups, one of them the buckets
+        for n in range(0,len(group),24):
+            prefixes = db.run_in_transaction_options(options, store_search_group, generation,
+                                                     owned_by, group[n:n+24], delete)
+            outdated.setdefault(str(owned_by),set()).update(['%d:%s' % (generation,prefix) for prefix in prefixes])
+    for namespace,cache_keys in outdated.items():
+        memcache.delete_multi(list(cache_keys), key_prefix='autocomplete:', namespace=namespace)
+
+
+def store_search_group(generation, owned_by, entries, delete):
+    """Stores (or deletes) SearchIndex entries of one user and index
+    generation and adds the changes of their keywords to the user's
+    PrefixBuckets. The keywords are compared with the stored version of
+    the entries, field keywords are not offered for autocompletion.
+    Must run in a (cross-group) transaction.
+
+    Returns the prefixes of the changed buckets.
+    """
+    old_entries = db.get([entry.key() for entry in entries])
+
+    # count how often a token is added (1) or removed (-1) per bucket
+    changes = {}
+    for old,new in zip(old_entries,entries):
+        delta = {}
+        if old and not old.attic:
+            for token in set(old.keys):
+                if not is_field_query(token):
+                    delta[token] = delta.get(token,0) - 1
+        if not new.attic and not delete:
+            for token in set(new.keys):
+                if not is_field_query(token):
+                    delta[token] = delta.get(token,0) + 1
+        for token,diff in delta.items():
+            if diff:
+                bucket = changes.setdefault(token[:1],{})
+                bucket[token] = bucket.get(token,0) + diff
+
+    parent = prefix_bucket_parent(generation, owned_by)
+    prefixes = changes.keys()
+    buckets = PrefixBucket.get_by_key_name(prefixes, parent=parent)
+    puts = []
+    deletes = []
+    for prefix,bucket in zip(prefixes,buckets):
+        if not bucket:
+            bucket = PrefixBucket(parent=parent, key_name=prefix, generation=generation,
+                                  owned_by=owned_by, prefix=prefix)
+        counts = dict(zip(bucket.tokens,bucket.counts))
+        for token,diff in changes[prefix].items():
+            counts[token] = counts.get(token,0) + diff
+            if counts[token] <= 0:
+                del counts[token]
+        if counts:
+            bucket.tokens = counts.keys()
+            bucket.counts = [counts[token] for token in bucket.tokens]
+            puts.append(bucket)
+        elif bucket.is_saved():
+            deletes.append(bucket)
+    if delete:
+        deletes.extend(entries)
+    else:
+        puts.extend(entries)
+    db.put(puts)
+    db.delete(deletes)
+    return prefixes
+
+
+def keyword_counts(login_user, query):
+    """Returns a list of (keyword,count) tuples for the keywords from
+    login_user's address book which start with query. Most frequent
+    keywords come first.
+
+    The keywords are read from the PrefixBucket for the first letter of
+    query which is cached in memcache.
+    """
+    if not query:
+        return []
+    namespace = str(login_user.key())
+    generation = current_generation()
+    prefix = query[:1]
+    cache_key = 'autocomplete:%d:%s' % (generation,prefix)
+    tokens = memcache.get(cache_key, namespace=namespace)
+    if tokens is None:
+        tokens = []
+        bucket = PrefixBucket.get_by_key_name(prefix, parent=prefix_bucket_parent(generation, login_user.key()))
+        if bucket:
+            tokens = zip(bucket.tokens,bucket.counts)
+            tokens.sort(key=lambda token: token[1], reverse=True)
+        memcache.set(cache_key, tokens, time=settings.AUTOCOMPLETE_CACHE_TIME, namespace=namespace)
+    return [(token,count) for token,count in tokens if token.startswith(query)]
+
+
+def autocomplete(login_user, query, limit=16):
+    """Returns up to limit keywords from login_user's address book which
+    start with query. Most frequent keywords come first."""
+    return [token for token,count in keyword_counts(login_user, query)][:limit]
+
+def continue_job(handler, job, enqueue):
+    """Handles the restart and resume parameters of an admin call which
+    starts a chain of tasks (see advance_checkpoint).
+
+    Returns True if job is still running, so that no new job is started.
+    With resume=True the chain is queued again from the last checkpoint
+    (needed if it was broken), the step is increased so that a task of
+    the old chain which is still around stops.
+    """
+    if not job or job.done or handler.request.get("restart", None):
+        return False
+    if handler.request.get("resume", None):
+        job.step = job.step + 1
+        job.put()
+        enqueue(job)
+    return True
+
+
+def advance_checkpoint(job, step, enqueue):
+    """Stores the checkpoint (an IndexJob, FixReport or ExportShard) of a
+    task chain after the task of step is done and queues the next task
+    by enqueue(job, transactional=True) in the same transaction. The rate
+    of an IndexJob is updated.
+
+    Returns False if the step was already done by another delivery of the
+    task, which must not fork the chain.
+    """
+    if isinstance(job, IndexJob):
+        elapsed = datetime.now() - job.started
+        seconds = elapsed.days*86400 + elapsed.seconds + elapsed.microseconds/1000000.0
+        if seconds > 0:
+            job.rate = job.count / seconds
+    job.step = step + 1
+
+    def checkpoint():
+        current = job.__class__.get(job.key())
+        if not current or current.step != step:
+            return False
+        job.put()
+        if not job.done:
+            enqueue(job, transactional=True)
+        return True
+    if not db.run_in_transaction(checkpoint):
+        logging.info("Step %d was already done by another task." % (step))
+        return False
+    return True
+
+
 class PurgeIndex(webapp.RequestHandler):
     """Used by administrator"""
 
     def get(self):
+        """Starts to delete the search index as a chain of tasks
+        (see PurgeIndexTask)
+
+        owner (a LoginUser key) restricts the purge to one user's index,
+        generation to one index generation. While a purge is running the
+        call only reports its progress; restart=True starts over and
+        resume=True continues from the last checkpoint.
+        """
         if not users.is_current_user_admin():
             logging.critical("PurgeIndex called by non-admin")
             self.error(500)
             return
 
-        logging.info("Purge index tables.")
+        job = IndexJob.get_by_key_name('purge')
+        if not continue_job(self, job, enqueue_purge_task):
+            owner = self.request.get("owner", None)
+            generation = self.request.get("generation", None)
+            logging.info("Purge index tables (owner: %s generation: %s)." % (owner,generation))
+            job = IndexJob(key_name='purge', table=PURGE_TABLES[0].kind(),
+                           generation=int(generation) if generation else None,
+                           owned_by=Key(owner) if owner else None,
+                           started=datetime.now())
+            job.put()
+            enqueue_purge_task(job)
+
+        self.response.headers['Content-Type'] = "text/plain"
+        self.response.out.write(purge_job_status(job))
+
+
+# tables which are deleted by a purge, in this order
+PURGE_TABLES = [SearchIndex,GeoIndex,PrefixBucket]
+
+def enqueue_purge_task(job, transactional=False):
+    """Queues the task which deletes the next batch of a purge"""
+    taskqueue.add(url='/indexpurge_task', queue_name="index",
+                  params={'job': job.key().name(), 'step': job.step},
+                  transactional=transactional)
+
+def purge_job_status(job):
+    """Returns a line of text describing the progress of a purge"""
+    if job.done:
+        return "/indexpurge done. %d datasets deleted (%.1f/s)." % (job.count,job.rate)
+    return "/indexpurge running: %s, %d datasets deleted (%.1f/s) so far." % (job.table,job.count,job.rate)
 
-        alldata = []
-        for data in SearchIndex.all():
-            alldata.append(data.key())
-        db.delete(alldata)
-        logging.info("%d datasets deleted in SearchIndex." % (len(alldata)))
 
-        alldata = []
-        for data in GeoIndex.all():
-            alldata.append(data.key())
-        db.delete(alldata)
-        logging.info("%d datasets deleted in GeoIndex." % (len(alldata)))
+class PurgeIndexTask(webapp.RequestHandler):
+    """Used by task queue (chained from PurgeIndex)"""
+
+    def post(self):
+        """Deletes one batch of index entries
+
+        Works like UpdateIndexTask: the position is read from the IndexJob
+        checkpoint, which is advanced together with queueing the next task.
+        """
+        job = IndexJob.get_by_key_name(self.request.get("job"))
+        step = int(self.request.get("step", "0"))
+        if not job or job.done or job.step != step:
+            logging.info("Purge task step %d is outdated." % (step))
+            return
+
+        tables = [table.kind() for table in PURGE_TABLES]
+        table = PURGE_TABLES[tables.index(job.table)]
+        owned_by = IndexJob.owned_by.get_value_for_datastore(job)
+        query = db.Query(table, keys_only=True)
+        if owned_by:
+            query.filter("owned_by =", owned_by)
+        if job.generation is not None:
+            query.filter("generation =", job.generation)
+        if job.cursor:
+            query.with_cursor(job.cursor)
+        keys = query.fetch(settings.INDEX_BATCH_SIZE)
+        db.delete(keys)
+        if table == PrefixBucket:
+            # drop the cached autocompletion keywords of the buckets
+            outdated = {}
+            for key in keys:
+                if not key.parent():
+                    # stored before the buckets were grouped per user
+                    continue
+                generation,owner = key.parent().name().split(":",1)
+                outdated.setdefault(owner,[]).append('%s:%s' % (generation,key.name()))
+            for namespace,cache_keys in outdated.items():
+                memcache.delete_multi(cache_keys, key_prefix='autocomplete:', namespace=namespace)
+
+        # advance the checkpoint
+        job.count = job.count + len(keys)
+        if len(keys) == settings.INDEX_BATCH_SIZE:
+            job.cursor = query.cursor()
+        elif tables.index(job.table) + 1 < len(tables):
+            job.table = tables[tables.index(job.table) + 1]
+            job.cursor = None
+        else:
+            job.done = True
+        if not advance_checkpoint(job, step, enqueue_purge_task):
+            return
+        logging.info("%d %s datasets deleted. %s" % (len(keys),table.kind(),purge_job_status(job)))
+
+        if job.done:
+            # cached search results refer to the deleted entries
+            namespaces = [str(owned_by)] if owned_by else []
+            for namespace in namespaces + [None]:
+                memcache.incr('lookup_generation', namespace=namespace,
+                              initial_value=lookup_cache_seed())
+
+
+class MigrateIndex(webapp.RequestHandler):
+    """Used by administrator (one-off)
+
+    Converts SearchIndex and GeoIndex rows which were stored with a
+    numeric id into rows keyed by their data_ref (see index_key_name).
+    Rows which were stored before index generations were introduced are
+    stored again to add them to generation 0.
+    """
+
+    def get(self):
+        """Starts the migration as a chain of tasks (see MigrateIndexTask)
+
+        While the migration is running the call only reports its progress;
+        restart=True starts over and resume=True continues from the last
+        checkpoint.
+        """
+        if not users.is_current_user_admin():
+            logging.critical("MigrateIndex called by non-admin")
+            self.error(500)
+            return
+
+        job = IndexJob.get_by_key_name('migrate')
+        if not continue_job(self, job, enqueue_migrate_task):
+            logging.info("Migrate index tables.")
+            job = IndexJob(key_name='migrate', table=MIGRATE_TABLES[0].kind(), started=datetime.now())
+            job.put()
+            enqueue_migrate_task(job)
 
         self.response.headers['Content-Type'] = "text/plain"
-        self.response.out.write("/indexpurge done.")
+        self.response.out.write(migrate_job_status(job))
+
+
+# tables which are converted by a migration, in this order
+MIGRATE_TABLES = [SearchIndex,GeoIndex]
+
+def enqueue_migrate_task(job, transactional=False):
+    """Queues the task which converts the next batch of a migration"""
+    taskqueue.add(url='/indexmigrate_task', queue_name="index",
+                  params={'job': job.key().name(), 'step': job.step},
+                  transactional=transactional)
+
+def migrate_job_status(job):
+    """Returns a line of text about the progress of a migration"""
+    if job.done:
+        return "/indexmigrate done: %d datasets migrated." % (job.count)
+    return "/indexmigrate running: %s, %d datasets migrated (%.1f/s) so far." % (job.table,job.count,job.rate)
+
+
+class MigrateIndexTask(webapp.RequestHandler):
+    """Used by task queue (chained from MigrateIndex)"""
+
+    def post(self):
+        """Converts one page of index entries
+
+        Works like UpdateIndexTask: the position is read from the IndexJob
+        checkpoint, which is advanced together with queueing the next task.
+        """
+        job = IndexJob.get_by_key_name(self.request.get("job"))
+        step = int(self.request.get("step", "0"))
+        if not job or job.done or job.step != step:
+            logging.info("Migrate task step %d is outdated." % (step))
+            return
+
+        tables = [table.kind() for table in MIGRATE_TABLES]
+        table = MIGRATE_TABLES[tables.index(job.table)]
+        query = table.all()
+        if job.cursor:
+            query.with_cursor(job.cursor)
+        page = query.fetch(settings.INDEX_BATCH_SIZE)
+        legacy = [data for data in page if not data.key().name()]
+        # load the indexed datasets in one go and rebuild their entries
+        data_refs = db.get([table.data_ref.get_value_for_datastore(data) for data in legacy])
+        batch = []
+        for obj in data_refs:
+            if obj:
+                batch.extend(update_index(obj, batch=True) or [])
+        # missing generation properties are written with their default
+        # (generation 0 is a valid value, so the property itself is checked)
+        unversioned = [data for data in page if data.key().name() and 'generation' not in data._entity]
+        batch.extend(unversioned)
+        store_index_update(batch)
+        db.delete(legacy)
+
+        # advance the checkpoint
+        job.count = job.count + len(legacy) + len(unversioned)
+        if len(page) == settings.INDEX_BATCH_SIZE:
+            job.cursor = query.cursor()
+        elif tables.index(job.table) + 1 < len(tables):
+            job.table = tables[tables.index(job.table) + 1]
+            job.cursor = None
+        else:
+            job.done = True
+        if not advance_checkpoint(job, step, enqueue_migrate_task):
+            return
+        logging.info("%d %s datasets migrated. %s" % (len(legacy)+len(unversioned),table.kind(),migrate_job_status(job)))
 
 
 class UpdateIndex(webapp.RequestHandler):
@@ -177,6 +756,13 @@ class UpdateIndex(webapp.RequestHandler):
         """Function is called by cron to build a contact index
 
         Call with a key to build index for this entity.
+        Otherwise a rebuild of the whole index is started which runs
+        as a chain of tasks (see UpdateIndexTask). While a rebuild is
+        running the call only reports its progress; restart=True starts
+        over and resume=True continues from the last checkpoint (needed
+        if the task chain was broken).
+        Index rows which were written before the index entities were keyed
+        by their data_ref are converted by /indexmigrate.
         """
         if not users.is_current_user_admin():
             logging.critical("UpdateIndex called by non-admin")
@@ -190,14 +776,15 @@ class UpdateIndex(webapp.RequestHandler):
         if key:
             con = Contact.get(Key(key))
             if con:
-                update_index(con)
+                batch = update_index(con, batch=True)
                 # update dependant take2 entries
                 for t2 in Take2.all().filter("contact_ref =", con):
-                    update_index(t2)
+                    batch.extend(update_index(t2, batch=True) or [])
                 # update parent login_user
                 user = LoginUser.all().filter("me =", con).get()
                 if user:
-                    update_index(user)
+                    batch.extend(update_index(user, batch=True) or [])
+                store_index_update(batch)
                 return
             else:
                 t2 = Take2.get(Key(key))
@@ -207,59 +794,424 @@ class UpdateIndex(webapp.RequestHandler):
             logging.info("Could not find key: %s" % (key))
             return
 
-        # Go through the tables which contribute to the index
-        for table in [LoginUser,Contact,Address]:
-            batch = []
-            for obj in table.all():
-                res = update_index(obj, batch=True)
-                if res:
-                    batch.extend(res)
-
-            # bulk db operation
-            db.put(batch)
-            logging.info("%d updates." % (len(batch)))
+        job = IndexJob.get_by_key_name('rebuild')
+        if not continue_job(self, job, enqueue_index_task):
+            # the rebuild writes a new index generation. Searches keep reading
+            # the current one until the rebuild is done.
+            generation = db.run_in_transaction(start_generation)
+            memcache.delete('index_generation')
+            # Go through the tables which contribute to the index
+            job = IndexJob(key_name='rebuild', table=INDEX_TABLES[0].kind(),
+                           generation=generation, started=datetime.now())
+            job.put()
+            # give all instances the time to notice the new generation
+            enqueue_index_task(job, countdown=settings.INDEX_GENERATION_CACHE_TIME)
 
         self.response.headers['Content-Type'] = "text/plain"
-        self.response.out.write("/index done.")
+        self.response.out.write(index_job_status(job))
+
+
+# tables which contribute to the index, in the order they are rebuilt
+INDEX_TABLES = [LoginUser,Contact,Take2]
 
-def lookup_contacts(term, include_attic=False):
+def enqueue_index_task(job, transactional=False, countdown=0):
+    """Queues the task which processes the next page of an index rebuild"""
+    taskqueue.add(url='/index_task', queue_name="index",
+                  params={'job': job.key().name(), 'step': job.step},
+                  transactional=transactional, countdown=countdown)
+
+def index_job_status(job):
+    """Returns a line of text describing the progress of an index rebuild"""
+    if job.done:
+        return "/index done. generation %d: %d datasets (%.1f/s)." % (job.generation,job.count,job.rate)
+    return "/index running: generation %d %s, %d datasets (%.1f/s) so far." % (job.generation,job.table,job.count,job.rate)
+
+def start_generation():
+    """Allocates a new index generation for a rebuild (run in transaction)"""
+    pointer = IndexGeneration.get_by_key_name('index')
+    if not pointer:
+        pointer = IndexGeneration(key_name='index')
+    pointer.building = max(pointer.current,pointer.building or 0) + 1
+    pointer.put()
+    return pointer.building
+
+def switch_generation(generation):
+    """Makes a completely built index generation the current one
+
+    Older generations are removed by a task (see CollectIndexGarbage)
+    which waits until all instances have read the new pointer.
+    Nothing happens if the switch was already done.
+    """
+    def switch():
+        pointer = IndexGeneration.get_by_key_name('index')
+        if not pointer or pointer.building != generation:
+            return False
+        pointer.current = generation
+        pointer.building = None
+        pointer.put()
+        taskqueue.add(url='/index_gc', queue_name="index",
+                      params={'generation': generation},
+                      countdown=2*settings.INDEX_GENERATION_CACHE_TIME,
+                      transactional=True)
+        return True
+
+    if db.run_in_transaction(switch):
+        memcache.delete('index_generation')
+        logging.info("Index generation %d is now in use." % (generation))
+
+
+class UpdateIndexTask(webapp.RequestHandler):
+    """Used by task queue (chained from UpdateIndex)"""
+
+    def post(self):
+        """Rebuilds the index for one page of a table
+
+        The task reads its position from the IndexJob checkpoint. When the
+        page is stored, the checkpoint is advanced and the task for the next
+        page is queued in the same transaction. A retried task simply
+        repeats its page (index entries are overwritten), a task which was
+        superseded by a later step does nothing.
+        """
+        job = IndexJob.get_by_key_name(self.request.get("job"))
+        step = int(self.request.get("step", "0"))
+        if not job or job.done or job.step != step:
+            logging.info("Index task step %d is outdated." % (step))
+            if job and job.done:
+                # the switch may have failed after the last checkpoint
+                switch_generation(job.generation)
+            return
+
+        tables = [table.kind() for table in INDEX_TABLES]
+        table = INDEX_TABLES[tables.index(job.table)]
+        query = table.all()
+        if job.cursor:
+            query.with_cursor(job.cursor)
+        page = query.fetch(settings.INDEX_BATCH_SIZE)
+
+        batch = []
+        for obj in page:
+            batch.extend(update_index(obj, batch=True, generations=[job.generation]) or [])
+        # bulk db operation
+        store_index_update(batch)
+
+        # advance the checkpoint
+        job.count = job.count + len(page)
+        if len(page) == settings.INDEX_BATCH_SIZE:
+            job.cursor = query.cursor()
+        elif tables.index(job.table) + 1 < len(tables):
+            job.table = tables[tables.index(job.table) + 1]
+            job.cursor = None
+        else:
+            job.done = True
+        if not advance_checkpoint(job, step, enqueue_index_task):
+            return
+        logging.info("%d updates from %d %s datasets. %s" % (len(batch),len(page),table.kind(),index_job_status(job)))
+
+        if job.done:
+            switch_generation(job.generation)
+
+
+class CollectIndexGarbage(webapp.RequestHandler):
+    """Used by task queue (queued by switch_generation)"""
+
+    def post(self):
+        """Deletes a batch of index entries which are older than generation
+        and queues itself again until all of them are gone"""
+        generation = int(self.request.get("generation"))
+        count = 0
+        for table in [SearchIndex,GeoIndex,PrefixBucket]:
+            query = db.Query(table, keys_only=True)
+            query.filter("generation <", generation)
+            keys = query.fetch(settings.INDEX_BATCH_SIZE)
+            db.delete(keys)
+            count = count + len(keys)
+        logging.info("Index garbage collection deleted %d entries older than generation %d." % (count,generation))
+        if count:
+            taskqueue.add(url='/index_gc', queue_name="index",
+                          params={'generation': generation})
+
+
+def search_index_query(query, include_attic=False, owned_by=None, keys_only=False):
+    """Returns a SearchIndex query for the entries with a keyword which
+    starts with query"""
+    q_pk = db.Query(SearchIndex, keys_only=keys_only)
+    q_pk.filter("generation =", current_generation())
+    if owned_by:
+        q_pk.filter("owned_by =", owned_by)
+    q_pk.filter("keys >=", query)
+    q_pk.filter("keys <", query+u"\ufffd")
+    if not include_attic:
+        q_pk.filter("attic =", False)
+    return q_pk
+
+
+def scan_contacts(query, include_attic=False, owned_by=None):
+    """Returns the set of contact keys which have a keyword starting with query
+
+    At most settings.LOOKUP_MAX_EXPANSION index entries are read.
+    """
+    contacts = set()
+    q_pk = search_index_query(query, include_attic, owned_by)
+    entries = q_pk.fetch(settings.LOOKUP_MAX_EXPANSION)
+    if len(entries) == settings.LOOKUP_MAX_EXPANSION:
+        logging.warning("lookup_contacts: search for '%s' stopped after %d index entries" % (query,len(entries)))
+    for con_idx in entries:
+        # insert contact index (not the object!) to avoid duplicates
+        contacts.add(SearchIndex.contact_ref.get_value_for_datastore(con_idx))
+    return contacts
+
+
+def fuzzy_contacts(query, include_attic=False, owned_by=None):
+    """Returns a dictionary of contact keys and their similarity (0.0..1.0)
+    for contacts which have a keyword similar to query (typo tolerant)
+
+    Candidates are index entries which share trigrams with query. For every
+    trigram at most settings.FUZZY_GRAM_LIMIT entries are read, only the
+    settings.FUZZY_MAX_CANDIDATES entries sharing the most trigrams are
+    loaded and compared with query.
+    """
+    hits = {}
+    for gram in trigrams(query):
+        q_pk = db.Query(SearchIndex, keys_only=True)
+        q_pk.filter("generation =", current_generation())
+        q_pk.filter("owned_by =", owned_by)
+        q_pk.filter("grams =", gram)
+        if not include_attic:
+            q_pk.filter("attic =", False)
+        for key in q_pk.fetch(settings.FUZZY_GRAM_LIMIT):
+            hits[key] = hits.get(key,0) + 1
+    candidates = sorted(hits.keys(), key=lambda key: hits[key], reverse=True)
+
+    contacts = {}
+    for con_idx in db.get(candidates[:settings.FUZZY_MAX_CANDIDATES]):
+        if not con_idx:
+            continue
+        similarity = max([trigram_similarity(query, key) for key in con_idx.keys
+                          if not is_field_query(key)] or [0.0])
+        if similarity >= settings.FUZZY_THRESHOLD:
+            contact = SearchIndex.contact_ref.get_value_for_datastore(con_idx)
+            contacts[contact] = max(similarity,contacts.get(contact,0.0))
+    return contacts
+
+
+def phonetic_contacts(query, include_attic=False, owned_by=None):
+    """Returns the set of contact keys which have a name sounding like query"""
+    contacts = set()
+    q_pk = db.Query(SearchIndex)
+    q_pk.filter("generation =", current_generation())
+    if owned_by:
+        q_pk.filter("owned_by =", owned_by)
+    q_pk.filter("phonetic =", cologne_phonetic(query))
+    if not include_attic:
+        q_pk.filter("attic =", False)
+    for con_idx in q_pk.fetch(settings.LOOKUP_MAX_EXPANSION):
+        contacts.add(SearchIndex.contact_ref.get_value_for_datastore(con_idx))
+    return contacts
+
+
+def plan_lookup(queries, owned_by=None):
+    """Orders the search terms so that the most selective comes first
+
+    The number of index entries per term is estimated from the keyword
+    counts in the user's prefix buckets. Without user (or for terms not
+    in the buckets) longer terms are assumed to be more selective. Field
+    searches are not counted in the buckets.
+    Returns a list of (estimate,term) tuples, estimate is None if unknown.
+    """
+    plan = []
+    for query in queries:
+        estimate = None
+        if owned_by and not is_field_query(query):
+            counts = keyword_counts(owned_by, query)
+            if counts:
+                estimate = sum([count for token,count in counts])
+        plan.append((estimate,query))
+    plan.sort(key=lambda step: (step[0] is None, step[0], -len(step[1])))
+    return plan
+
+
+def lookup_contacts(term, include_attic=False, owned_by=None, phonetic=False):
     """Lookup function for search term.
 
     Splits term if more than one word and looks for contacts which have _all_
     search terms in their relevant(indexed) fields. Indexed is name, nickname,
     lastname and town.
+    If owned_by (a LoginUser) is given, only this user's part of the index
+    is scanned.
+    The most selective term is looked up first (see plan_lookup). The other
+    terms are checked against its result: a few candidates are probed with
+    keys only queries, otherwise the term is looked up and intersected.
+    If nothing is found, contacts with similar keywords are returned
+    (see fuzzy_contacts; only for a user's search).
+    If phonetic is set, the terms are compared by their sound with names,
+    last names and nicknames (see phonetic_contacts).
+    A user's search can qualify terms with a field, e.g. email:gmail.com or
+    phone:0171 (see field_query). Such terms are looked up in the field
+    keywords of the index.
+    Results are cached (see lookup_cache_key).
     Returns a list with Contact keys.
     """
 
     queries = plainify(term)
+    if not queries:
+        return []
+    if owned_by:
+        queries = [field_query(query) for query in queries]
 
-    logging.debug("lookup_contacts searches for %s" % " ".join(queries))
+    # repeated searches are answered from memcache
+    namespace = str(owned_by.key()) if owned_by else None
+    cache_key = lookup_cache_key(queries, include_attic, owned_by, phonetic)
+    cached = memcache.get(cache_key, namespace=namespace)
+    if cached is not None:
+        memcache.incr('lookup_hits', namespace='lookup_stats', initial_value=0)
+        return cached
+    memcache.incr('lookup_misses', namespace='lookup_stats', initial_value=0)
 
-    query_contacts = []
-    for query in queries:
-        contacts = {}
-        query0 = query
-        query1 = query0+u"\ufffd"
-        # look up plain query string in list of plain keys
-        q_pk = db.Query(SearchIndex)
-        q_pk.filter("keys >=", query0)
-        q_pk.filter("keys <", query1)
-        if not include_attic:
-            q_pk.filter("attic =", False)
-        for con_idx in q_pk:
-            # insert contact index (not the object!) into a dictionary to avoid duplicates
-            contacts[SearchIndex.contact_ref.get_value_for_datastore(con_idx)] = None
-        # convert from map to set
-        query_contacts.append(set(contacts.keys()))
+    if phonetic:
+        contacts = None
+        for query in queries:
+            if is_field_query(query):
+                matches = scan_contacts(query, include_attic, owned_by)
+            else:
+                matches = phonetic_contacts(query, include_attic, owned_by)
+            contacts = matches if contacts is None else contacts.intersection(matches)
+        contacts = list(contacts)
+        memcache.set(cache_key, contacts, time=settings.LOOKUP_CACHE_TIME, namespace=namespace)
+        return contacts
+
+    plan = plan_lookup(queries, owned_by)
+    logging.debug("lookup_contacts searches for %s" % " ".join(["%s(%s)" % (query,estimate) for estimate,query in plan]))
+
+    estimate,query = plan[0]
+    contacts = scan_contacts(query, include_attic, owned_by)
+
+    # Now we need to find the contacts (hopefully very few) which
+    # also match the other terms
+    for estimate,query in plan[1:]:
+        if not contacts:
+            break
+        if len(contacts) <= settings.LOOKUP_PROBE_LIMIT:
+            matches = set()
+            for contact in contacts:
+                q_pk = search_index_query(query, include_attic, owned_by, keys_only=True)
+                q_pk.filter("contact_ref =", contact)
+                if q_pk.get():
+                    matches.add(contact)
+            contacts = matches
+        else:
+            contacts = contacts.intersection(scan_contacts(query, include_attic, owned_by))
+
+    if (not contacts and settings.TRIGRAM_INDEX and owned_by
+        and not [query for query in queries if is_field_query(query)]):
+        # nothing found, maybe a typo. Look for similar keywords instead
+        similar = None
+        for query in queries:
+            matches = fuzzy_contacts(query, include_attic, owned_by)
+            if similar is None:
+                similar = matches
+            else:
+                similar = dict([(contact,similarity+matches[contact])
+                                for contact,similarity in similar.items() if contact in matches])
+        # best matches first
+        contacts = sorted(similar.keys(), key=lambda contact: similar[contact], reverse=True)
+
+    contacts = list(contacts)
+    memcache.set(cache_key, contacts, time=settings.LOOKUP_CACHE_TIME, namespace=namespace)
+    return contacts
+
+class IndexWorker(webapp.RequestHandler):
+    """Used by task queue (queued by schedule_index_update)"""
+
+    def post(self):
+        """Updates the index for a batch of saved datasets
+
+        The updates are leased from the index-pending pull queue. The
+        datasets are read with one batch get and updated one by one. Failed
+        updates stay in the queue and are dropped after
+        settings.INDEX_MAX_RETRIES attempts. The time between save and index
+        update is recorded as index lag (see LookupStats).
+        """
+        queue = taskqueue.Queue('index-pending')
+        tasks = queue.lease_tasks(settings.INDEX_LEASE_TIME, settings.INDEX_BATCH_SIZE)
+        if not tasks:
+            if queue.fetch_statistics().tasks:
+                # leased by a worker which may have failed, look again
+                # when the lease has expired
+                taskqueue.add(url='/index_worker', queue_name="index", countdown=settings.INDEX_LEASE_TIME)
+            return
+        updates = [json.loads(task.payload) for task in tasks]
+        keys = list(set([update['key'] for update in updates]))
+        objs = dict(zip(keys, db.get([Key(key) for key in keys])))
+
+        # every dataset is updated on its own, so that one failure does not
+        # hold back the others
+        done = []
+        failed = []
+        updated = {}
+        for task,update in zip(tasks,updates):
+            key = update['key']
+            if key in updated:
+                (done if updated[key] else failed).append(task)
+                continue
+            if task.retry_count > settings.INDEX_MAX_RETRIES:
+                logging.error("Index update of %s dropped after %d attempts." % (key,task.retry_count))
+                done.append(task)
+                continue
+            # later saves queue a new update
+            memcache.delete(key, namespace='index_pending')
+            try:
+                if objs[key]:
+                    update_index(objs[key])
+                updated[key] = True
+                done.append(task)
+            except Exception:
+                logging.exception("Index update of %s failed." % (key))
+                updated[key] = False
+                failed.append(task)
+        queue.delete_tasks(done)
 
-    # At this point we have the result sets (contact keys) for the words in the query.
-    # Now we need to find the contacts (hopefully very few) which are in _all_
-    # of the contact sets
-    contacts = query_contacts[0]
-    for cons in query_contacts[1:]:
-        contacts = contacts.intersection(cons)
+        if done:
+            lag = time.time() - min([update['queued'] for task,update in zip(tasks,updates) if task in done])
+            memcache.set('index_lag', lag, namespace='lookup_stats')
+            memcache.incr('index_updates', len([key for key in updated if updated[key]]),
+                          namespace='lookup_stats', initial_value=0)
+            logging.info("Index updated for %d datasets, lag %.1fs." % (len(updated),lag))
 
-    return list(contacts)
+        if failed:
+            # the failed updates can be leased again when their lease expires
+            taskqueue.add(url='/index_worker', queue_name="index", countdown=settings.INDEX_LEASE_TIME)
+        elif len(tasks) == settings.INDEX_BATCH_SIZE:
+            # there may be more waiting
+            taskqueue.add(url='/index_worker', queue_name="index")
+
+
+class LookupStats(webapp.RequestHandler):
+    """Used by administrator"""
+
+    def get(self):
+        """Returns the hit and miss counters of the search result cache
+        and the lag of the background index updates (in seconds)"""
+        if not users.is_current_user_admin():
+            logging.critical("LookupStats called by non-admin")
+            self.error(500)
+            return
+
+        stats = memcache.get_multi(['lookup_hits','lookup_misses','index_lag','index_updates'],
+                                   namespace='lookup_stats')
+        hits = stats.get('lookup_hits',0)
+        misses = stats.get('lookup_misses',0)
+        res = {'hits': hits, 'misses': misses,
+               'index_lag': stats.get('index_lag',0.0), 'index_updates': stats.get('index_updates',0)}
+        stats = taskqueue.Queue('index-pending').fetch_statistics()
+        res['index_pending'] = stats.tasks
+        if stats.oldest_eta_usec:
+            # age of the oldest waiting update
+            res['index_pending_age'] = time.time() - stats.oldest_eta_usec/1000000.0
+        if hits + misses:
+            res['hit_ratio'] = float(hits) / (hits + misses)
+
+        self.response.headers['Content-Type'] = "text/plain"
+        self.response.out.write(json.dumps(res))
 
 class LookupNames(webapp.RequestHandler):
     """Quick lookup for search field autocompletion"""
@@ -275,7 +1227,14 @@ class LookupNames(webapp.RequestHandler):
         'di' yields ['Dirk', 'Dieter', 'Diesbach']
         with more than one wordm the first  is simply returned in the result list
         'dieter h' yields ['dieter', 'Herbert', 'Hoheisel', 'Holdenbusch']
+
+        Signed in users only get keywords from their own address book,
+        served from the prefix buckets (see autocomplete).
         """
+        # imported here because take2access depends on this module
+        from take2access import get_login_user
+        login_user = get_login_user()
+
         term = self.request.get('term',"")
         queries = plainify(term)
         if not queries:
@@ -286,27 +1245,34 @@ class LookupNames(webapp.RequestHandler):
         # if the query string is more than one term, lookup only the last
         res0 = " ".join(queries[0:-1])
         query0 = queries[-1]
-        query1 = query0+u"\ufffd"
-        # look up plain query string
-        q_pk = db.Query(SearchIndex, keys_only=False)
-        q_pk.filter("keys >=", query0)
-        q_pk.filter("keys <", query1)
-        q_pk.filter("attic =", False)
-        # collect a max. of 16 distinct keys (or less if there aren't more)
-        distinct_keys = {}
-        for pk in q_pk:
-            for key in pk.keys:
-                if key >= query0 and key < query1:
-                    distinct_keys[key] = key.capitalize()
-            if len(distinct_keys) > 16:
-                break
+        if login_user:
+            distinct_keys = [key.capitalize() for key in autocomplete(login_user, query0)]
+        else:
+            query1 = query0+u"\ufffd"
+            # look up plain query string
+            q_pk = db.Query(SearchIndex, keys_only=False)
+            q_pk.filter("generation =", current_generation())
+            q_pk.filter("keys >=", query0)
+            q_pk.filter("keys <", query1)
+            q_pk.filter("attic =", False)
+            # collect a max. of 16 distinct keys (or less if there aren't more)
+            distinct_keys = {}
+            for pk in q_pk:
+                for key in pk.keys:
+                    if key >= query0 and key < query1:
+                        distinct_keys[key] = key.capitalize()
+                if len(distinct_keys) > 16:
+                    break
+            distinct_keys = distinct_keys.values()
         if len(res0):
-            res = [res0].append(distinct_keys.values())
+            res = [res0] + distinct_keys
         else:
-            res = distinct_keys.values()
+            res = distinct_keys
 
         # encode and return
         self.response.headers['Content-Type'] = "text/plain"
+        # results may be reused by the browser for repeated keystrokes
+        self.response.headers['Cache-Control'] = "private, max-age=%d" % (settings.AUTOCOMPLETE_MAX_AGE)
         self.response.out.write(json.dumps(res))
 
 class FixDb(webapp.RequestHandler):
@@ -316,118 +1282,167 @@ class FixDb(webapp.RequestHandler):
     """
 
     def get(self):
+        """Starts the check as parallel shards (see FixDbTask)
+
+        Every table is split into up to shards key ranges. While a check
+        is running the call only reports its progress and findings;
+        restart=True starts over. report=True shows the result of the
+        last check. Datasets which depend on fixed datasets are found by
+        the next check.
+        """
         if not users.is_current_user_admin():
-            logging.critical("UpdateIndex called by non-admin")
+            logging.critical("FixDb called by non-admin")
             self.error(500)
             return
 
-        fix = True if self.request.get("fix", "False") == "True" else False
+        reports = FixReport.all().fetch(1000)
+        running = [report for report in reports if not report.done]
+        if (not running and not self.request.get("report", None)) or self.request.get("restart", None):
+            fix = True if self.request.get("fix", "False") == "True" else False
+            shards = int(self.request.get("shards", settings.FIX_SHARDS))
+            db.delete(reports)
+            reports = start_fix(fix, shards)
 
-        # look for LoginUser with invalid Person attached
-        logging.info("Check LoginUser")
-        err = False
-        for obj in LoginUser.all():
-            try:
-                if not obj.me:
-                    logging.critical("LoginUser %d has no Person attached" % ((obj.key().id())))
-                    err = True
-            except db.ReferencePropertyResolveError:
-                logging.critical("LoginUser %d has invalid Person reference" % ((obj.key().id())))
-                err = True
-            if err:
-                # check for dependent datasets
-                count = Contact.all().filter("owned_by =", obj).count()
-                logging.critical("LoginUser %d has %d dependant datasets" % (obj.key().id(),count))
-                if fix:
-                    obj.delete()
-                    logging.info("%d deleted" % obj.key().id())
-            err = False
-
-
-        logging.info("Check Contact")
-        err = False
-        for obj in Contact.all():
-            try:
-                if not obj.owned_by:
-                    logging.critical("Contact '%s' %d has no reference to owner" % (obj.name,obj.key().id()))
-                    err = True
-            except db.ReferencePropertyResolveError:
-                logging.critical("Contact '%s' %d has invalid reference to owner" % (obj.name,obj.key().id()))
-                count = LoginUser.all().filter("me =", obj).count()
-                if count:
-                    logging.critical("... but owner has reference!")
-                err = True
-            if err:
-                # check for dependent datasets
-                count = Take2.all().filter("contact_ref =", obj).count()
-                logging.critical("Contact '%s' has %d dependent datasets" % (obj.name, count))
-                if fix:
-                    obj.delete()
-                    logging.info("%d deleted" % obj.key().id())
-            err = False
-
-        logging.info("Check Take2")
-        err = False
-        for obj in Take2.all():
-            try:
-                if not obj.contact_ref:
-                    logging.critical("Take2 has no reference to owner %s" % (obj.key().id()))
-                    err = True
-            except db.ReferencePropertyResolveError:
-                logging.critical("Take2 has invalid reference to owner %s" % (obj.key().id()))
-                err = True
-            if err:
-                if fix:
-                    obj.delete()
-                    logging.info("%d deleted" % obj.key().id())
-            # location in address shall be set to default
-            if obj.class_name() == 'Address' and not obj.location:
-                logging.error("Address has null location %s. Fixed." % (obj.key().id()))
-                obj.location=db.GeoPt(lon=0.0, lat=0.0)
-                obj.put()
-            err = False
+        res = []
+        for report in reports:
+            res.extend(report.findings)
+        res.append(fix_status(reports))
+        self.response.headers['Content-Type'] = "text/plain"
+        self.response.out.write("\n".join(res))
 
-        logging.info("Check SearchIndex")
-        err = False
-        for obj in SearchIndex.all():
-            try:
-                if not obj.contact_ref:
-                    logging.critical("SearchIndex %d has no reference to owner" % (obj.key().id()))
-                    err = True
-            except db.ReferencePropertyResolveError:
-                logging.critical("SearchIndex %d has invalid reference to owner" % (obj.key().id()))
-                err = True
-            if err:
-                if fix:
-                    obj.delete()
-                    logging.info("%d deleted" % obj.key().id())
-            err = False
-
-        logging.info("Check GeoIndex")
-        err = False
-        for obj in GeoIndex.all():
-            try:
-                if not obj.contact_ref:
-                    logging.critical("GeoIndex %d has no reference to owner" % (obj.key().id()))
-                    err = True
-            except db.ReferencePropertyResolveError:
-                logging.critical("GeoIndex %d has invalid reference to owner" % (obj.key().id()))
-                err = True
-            if err:
-                if fix:
-                    obj.delete()
-                    logging.info("%d deleted" % obj.key().id())
-            err = False
 
-        self.response.headers['Content-Type'] = "text/plain"
-        self.response.out.write("/fix done.")
+# tables which are checked by /fix and the reference which must be valid
+FIX_REFERENCES = [(LoginUser, LoginUser.me),
+                  (Contact, Contact.owned_by),
+                  (Take2, Take2.contact_ref),
+                  (SearchIndex, SearchIndex.contact_ref),
+                  (GeoIndex, GeoIndex.contact_ref)]
+
+def key_ranges(table, shards):
+    """Splits the keys of table into up to shards ranges of similar size
+
+    The boundaries are taken from the datastore's random sample of
+    entities (__scatter__). Returns a list of (start,end) keys, None
+    stands for an open end.
+    """
+    query = db.Query(table, keys_only=True)
+    query.order('__scatter__')
+    keys = sorted(query.fetch(shards-1))
+    bounds = [None] + keys + [None]
+    return [(bounds[n],bounds[n+1]) for n in range(len(bounds)-1)]
+
+def start_fix(fix, shards):
+    """Creates the FixReport shards of a new check and queues their
+    first tasks. Returns the reports."""
+    reports = []
+    for table,reference in FIX_REFERENCES:
+        for n,(start,end) in enumerate(key_ranges(table, shards)):
+            reports.append(FixReport(key_name="%s:%d" % (table.kind(),n), table=table.kind(),
+                                     start=str(start) if start else None,
+                                     end=str(end) if end else None,
+                                     fix=fix, started=datetime.now()))
+    db.put(reports)
+    for report in reports:
+        enqueue_fix_task(report)
+    logging.info("Database check started with %d shards (fix: %s)." % (len(reports),fix))
+    return reports
 
+def enqueue_fix_task(report, transactional=False):
+    """Queues the task which checks the next page of a FixReport shard"""
+    taskqueue.add(url='/fix_task', queue_name="index",
+                  params={'report': report.key().name(), 'step': report.step},
+                  transactional=transactional)
+
+def fix_status(reports):
+    """Returns a line of text summarizing the FixReport shards"""
+    done = len([report for report in reports if report.done])
+    return "/fix %s: %d of %d shards done. %d datasets checked, %d broken, %d fixed." % (
+        "done" if done == len(reports) else "running",done,len(reports),
+        sum([report.checked for report in reports]),
+        sum([report.broken for report in reports]),
+        sum([report.fixed for report in reports]))
+
+
+class FixDbTask(webapp.RequestHandler):
+    """Used by task queue (queued by FixDb)"""
+
+    def post(self):
+        """Checks one page of a shard's key range
+
+        The references of the page are read with one batch get. Broken
+        datasets are recorded in the shard's FixReport and, with fix=True,
+        deleted in one batch. Addresses without location get a default
+        location. The checkpoint works like the one of UpdateIndexTask.
+        """
+        report = FixReport.get_by_key_name(self.request.get("report"))
+        step = int(self.request.get("step", "0"))
+        if not report or report.done or report.step != step:
+            logging.info("Fix task step %d is outdated." % (step))
+            return
+
+        tables = [table.kind() for table,reference in FIX_REFERENCES]
+        table,reference = FIX_REFERENCES[tables.index(report.table)]
+        query = table.all()
+        if report.start:
+            query.filter("__key__ >=", Key(report.start))
+        if report.end:
+            query.filter("__key__ <", Key(report.end))
+        if report.cursor:
+            query.with_cursor(report.cursor)
+        page = query.fetch(settings.INDEX_BATCH_SIZE)
+
+        # resolve all references of the page at once
+        refs = [reference.get_value_for_datastore(obj) for obj in page]
+        ref_keys = list(set([ref for ref in refs if ref]))
+        existing = set([obj.key() for obj in db.get(ref_keys) if obj])
+
+        broken = []
+        located = []
+        for obj,ref in zip(page,refs):
+            if not ref:
+                finding = "%s %s has no %s reference" % (report.table,obj.key().id_or_name(),reference.name)
+            elif ref not in existing:
+                finding = "%s %s has invalid %s reference" % (report.table,obj.key().id_or_name(),reference.name)
+            else:
+                finding = None
+            if finding:
+                logging.critical(finding)
+                broken.append(obj.key())
+                if len(report.findings) < settings.FIX_MAX_FINDINGS:
+                    report.findings.append(finding)
+            elif report.table == 'Take2' and obj.class_name() == 'Address' and not obj.location:
+                # location in address shall be set to default
+                logging.error("Address has null location %s. Fixed." % (obj.key().id()))
+                obj.location = db.GeoPt(lon=0.0, lat=0.0)
+                located.append(obj)
+        if report.fix and broken:
+            db.delete(broken)
+            report.fixed = report.fixed + len(broken)
+        db.put(located)
+
+        # advance the checkpoint
+        report.checked = report.checked + len(page)
+        report.broken = report.broken + len(broken)
+        if len(page) == settings.INDEX_BATCH_SIZE:
+            report.cursor = query.cursor()
+        else:
+            report.done = True
+        if not advance_checkpoint(report, step, enqueue_fix_task):
+            return
 
 
 application = webapp.WSGIApplication([('/lookup', LookupNames),
+                                      ('/lookupstats', LookupStats),
                                       ('/index', UpdateIndex),
+                                      ('/index_task', UpdateIndexTask),
+                                      ('/index_gc', CollectIndexGarbage),
+                                      ('/index_worker', IndexWorker),
                                       ('/indexpurge', PurgeIndex),
+                                      ('/indexpurge_task', PurgeIndexTask),
+                                      ('/indexmigrate', MigrateIndex),
+                                      ('/indexmigrate_task', MigrateIndexTask),
                                       ('/fix', FixDb),
+                                      ('/fix_task', FixDbTask),
                                       ],settings.DEBUG)
 
 def main():
@@ -17,7 +17,8 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 from take2dbm import LoginUser, Person, FuzzyDate
 from take2access import get_login_user, get_current_user_template_values
 from take2beans import prepare_birthday_selectors, PersonBean
-from take2index import update_index
+from take2index import schedule_index_update
+from take2changes import log_change
 
 
 
@@ -108,9 +109,10 @@ class Take2Signup(webapp.RequestHandler):
             self.response.out.write(template.render(path, template_values))
             return
 
-        # create search index which is usually done by the PersonBean but not here
-        # because the index table is not in the entity group
-        update_index(person.entity)
+        # create search index and change log entry which is usually done by the
+        # PersonBean but not here because their tables are not in the entity group
+        log_change(person.entity, 'put')
+        schedule_index_update(person.entity)
 
         self.redirect('/')
 
@@ -7,6 +7,7 @@
 import settings
 import logging
 import os
+import base64
 from django.utils import simplejson as json
 import unicodedata
 from random import shuffle
@@ -21,7 +22,7 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.api import memcache
 from take2dbm import Contact, Person, Company, Take2, SearchIndex, Address, GeoIndex
 from take2access import get_login_user, get_current_user_template_values
-from take2index import lookup_contacts
+from take2index import lookup_contacts, current_generation
 from take2view import geocode_contact
 
 class Root(webapp.RequestHandler):
@@ -57,7 +58,8 @@ class MapPopulate(webapp.RequestHandler):
         geojson['features'] = []
 
         box = geo.geotypes.Box(maxlat,maxlon,minlat,minlon)
-        for geoix in GeoIndex.bounding_box_fetch(GeoIndex.all(), box, max_results=111):
+        q_geo = GeoIndex.all().filter("generation =", current_generation())
+        for geoix in GeoIndex.bounding_box_fetch(q_geo, box, max_results=111):
             try:
                 con = geocode_contact(geoix.contact_ref, include_attic=False, login_user=login_user)
                 if con:
@@ -78,13 +80,40 @@ class MapPopulate(webapp.RequestHandler):
         self.response.out.write(json.dumps(geojson))
 
 
+def encode_page_token(query, offset, include_attic, phonetic=False):
+    """Returns an opaque token which points to a page of search results"""
+    return base64.urlsafe_b64encode(json.dumps({'query': query, 'offset': offset,
+                                                'attic': include_attic, 'phonetic': phonetic}))
+
+def decode_page_token(token):
+    """Returns query, offset, include_attic and phonetic from a page token"""
+    try:
+        page = json.loads(base64.urlsafe_b64decode(str(token)))
+        return page['query'],int(page['offset']),bool(page['attic']),bool(page.get('phonetic',False))
+    except (TypeError, ValueError, KeyError):
+        logging.warning("Invalid page token: %s" % (token))
+        return "",0,False,False
+
+
 class MapData(webapp.RequestHandler):
-    """Handler for ajax request. Returns list of geocoded names"""
+    """Handler for ajax request. Returns list of geocoded names
+
+    The first page of results is returned for a query. The response contains
+    tokens for the next and previous page (if any) which can be passed in
+    as page parameter instead of the query.
+    With phonetic=True names are searched by their sound.
+    """
 
     def get(self):
         login_user = get_login_user()
-        query = self.request.get('query',"")
-        include_attic = True if self.request.get('attic',None) else False
+        page = self.request.get('page',None)
+        if page:
+            query,offset,include_attic,phonetic = decode_page_token(page)
+        else:
+            query = self.request.get('query',"")
+            offset = 0
+            include_attic = True if self.request.get('attic',None) else False
+            phonetic = True if self.request.get('phonetic',None) else False
 
         # data structures for data transport to client
         nongeo = []
@@ -98,15 +127,31 @@ class MapData(webapp.RequestHandler):
         maxlon = 0.0
 
         if query:
-            cis = lookup_contacts(query, include_attic)
+            cis = None
+            if login_user and page:
+                # page through the results of the last query if they are still cached
+                cached = memcache.get('query', namespace=str(login_user.key()))
+                if (cached and cached['query'] == query and cached.get('attic',False) == include_attic
+                    and cached.get('phonetic',False) == phonetic):
+                    cis = cached['results']
+            if cis is None:
+                cis = lookup_contacts(query, include_attic, owned_by=login_user, phonetic=phonetic)
+            offset = max(0,min(offset,len(cis)))
             # Save the query result in memcache together with the information about
-            # which portion of it we are displaying (the first result_size datasets as
-            # it is a fresh query!)
+            # which portion of it we are displaying
             if login_user:
-                if not memcache.set('query', {'query': query, 'offset': 0, 'results': cis}, time=5000, namespace=str(login_user.key())):
+                if not memcache.set('query', {'query': query, 'offset': offset, 'attic': include_attic,
+                                              'phonetic': phonetic, 'results': cis},
+                                    time=5000, namespace=str(login_user.key())):
                     logging.error("memcache failed")
-            # fetch a number of data from the results
-            for contact in db.get(cis[0:settings.RESULT_SIZE]):
+            # tokens for the neighbouring pages
+            geojson['total'] = len(cis)
+            if offset + settings.RESULT_SIZE < len(cis):
+                geojson['next'] = encode_page_token(query, offset+settings.RESULT_SIZE, include_attic, phonetic)
+            if offset > 0:
+                geojson['previous'] = encode_page_token(query, max(0,offset-settings.RESULT_SIZE), include_attic, phonetic)
+            # fetch the contacts of this page in one batch
+            for contact in db.get(cis[offset:offset+settings.RESULT_SIZE]):
                 if not contact:
                     # may happen if index is not up to date
                     logging.warning("Query returned invalid contact reference")
@@ -0,0 +1,162 @@
+"""Take2 delta sync REST Api. Clients read only the contacts and take2
+data which changed since their last sync.
+
+"""
+
+import settings
+import logging
+import base64
+from datetime import datetime, timedelta
+from django.utils import simplejson as json
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp.util import run_wsgi_app
+from take2dbm import Contact, Take2, ChangeLog
+from take2access import MembershipRequired
+from take2export import encode_take2_object
+from take2changes import read_changes
+from take2view import prefetch_take2, resolve_take2_references
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+def parse_timestamp(value):
+    """Returns the datetime of an isoformat timestamp (None if invalid)"""
+    for format in [TIMESTAMP_FORMAT,"%Y-%m-%dT%H:%M:%S"]:
+        try:
+            return datetime.strptime(value, format)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def format_timestamp(value):
+    """Returns a datetime as timestamp string (None stays None)"""
+    return value.strftime(TIMESTAMP_FORMAT) if value else None
+
+def encode_sync_token(state):
+    """Returns an opaque token for the position of a running sync"""
+    return base64.urlsafe_b64encode(json.dumps(state))
+
+def decode_sync_token(token):
+    """Returns the position of a running sync (None if invalid)"""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(str(token)))
+        return state if state['phase'] in ['contacts','take2'] else None
+    except (TypeError, ValueError, KeyError):
+        logging.warning("Invalid sync token: %s" % (token))
+        return None
+
+def encode_sync_contact(contact):
+    """Encodes a contact as a dictionary"""
+    res = {}
+    res['key'] = str(contact.key())
+    res['type'] = contact.class_name().lower()
+    res['timestamp'] = contact.timestamp.isoformat()
+    res['attic'] = contact.attic
+    res['name'] = contact.name
+    if contact.class_name() == "Person":
+        if contact.lastname:
+            res['lastname'] = contact.lastname
+        if contact.nickname:
+            res['nickname'] = contact.nickname
+        if contact.birthday.has_year() or contact.birthday.has_month() or contact.birthday.has_day():
+            res['birthday'] = "%04d-%02d-%02d" % (contact.birthday.year,contact.birthday.month,contact.birthday.day)
+    if contact.introduction:
+        res['introduction'] = contact.introduction
+    middleman = Contact.middleman_ref.get_value_for_datastore(contact)
+    if middleman:
+        res['middleman_ref'] = str(middleman)
+    return res
+
+
+class Take2Sync(webapp.RequestHandler):
+    """Delta sync of the user's own contacts"""
+
+    @MembershipRequired
+    def get(self, login_user=None, template_values={}):
+        """Returns the contacts and take2 data (also archived) which were
+        created, changed or archived after the watermark since as JSON:
+        {"contacts": [..], "take2": [..], "watermark": .., "next": ..}
+
+        The result is paged. As long as next is set, the client calls again
+        with page=next. After the last page the client keeps watermark and
+        passes it as since for the next sync. Without since, all data is
+        returned.
+
+        Contacts are found by their timestamp, take2 data by the owner's
+        change log (see take2changes). Changes of the last
+        settings.SYNC_SAFETY_MARGIN seconds are left for the next sync
+        because the queries may not see them yet.
+        """
+        page = self.request.get("page", None)
+        if page:
+            state = decode_sync_token(page)
+            if not state:
+                self.error(400)
+                return
+        else:
+            since = parse_timestamp(self.request.get("since", None))
+            until = datetime.now() - timedelta(seconds=settings.SYNC_SAFETY_MARGIN)
+            state = {'since': format_timestamp(since), 'until': format_timestamp(until),
+                     'phase': 'contacts', 'cursor': None}
+        since = parse_timestamp(state['since'])
+        until = parse_timestamp(state['until'])
+
+        res = {'contacts': [], 'take2': [], 'watermark': state['until']}
+        if state['phase'] == 'contacts':
+            query = Contact.all()
+            query.filter("owned_by =", login_user)
+            if since:
+                query.filter("timestamp >", since)
+            query.filter("timestamp <=", until)
+            query.order("timestamp")
+            if state['cursor']:
+                query.with_cursor(state['cursor'])
+            contacts = query.fetch(settings.CHANGES_BATCH_SIZE)
+            if not since:
+                # first sync: all data of the contacts
+                take2 = prefetch_take2(contacts, include_attic=True)
+            for contact in contacts:
+                res['contacts'].append(encode_sync_contact(contact))
+                if not since:
+                    for obj in take2[contact.key()]:
+                        res['take2'].append(encode_take2_object(obj))
+            if len(contacts) == settings.CHANGES_BATCH_SIZE:
+                state['cursor'] = query.cursor()
+            elif since:
+                state['phase'] = 'take2'
+                state['cursor'] = None
+            else:
+                state = None
+        else:
+            changes,cursor = read_changes(login_user, state['cursor'], since=since, until=until)
+            # a dataset may have changed several times, send it once
+            keys = []
+            for change in changes:
+                key = ChangeLog.data_ref.get_value_for_datastore(change)
+                if key.kind() == Take2.kind() and key not in keys:
+                    keys.append(key)
+            objs = [obj for obj in db.get(keys) if obj]
+            resolve_take2_references(objs)
+            for obj in objs:
+                res['take2'].append(encode_take2_object(obj))
+            if len(changes) == settings.CHANGES_BATCH_SIZE:
+                state['cursor'] = cursor
+            else:
+                state = None
+
+        if state:
+            res['next'] = encode_sync_token(state)
+
+        self.response.headers['Content-Type'] = "application/json"
+        self.response.out.write(json.dumps(res))
+
+
+application = webapp.WSGIApplication([('/sync', Take2Sync),
+                                     ],settings.DEBUG)
+
+def main():
+    logging.getLogger().setLevel(settings.LOG_LEVEL)
+    run_wsgi_app(application)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Take2 text functions for the search index (no datastore access)
+
+"""
+
+import unicodedata
+
+# characters stripped from the ends of a word by plainify
+PLAINIFY_STRIP = ",.;:\\?/!@#$%^&*()[]{}|\"'"
+# max. number of words kept in the plainify memo
+PLAINIFY_MEMO_SIZE = 10000
+
+
+class PlainifyTable(dict):
+    """Translation table for plainify. The replacement of a character
+    is computed the first time the character is seen."""
+
+    def __missing__(self, code):
+        c = unichr(code).lower()
+        c = unicodedata.normalize('NFD',c)
+        # only the base letters remain, accents and other characters are dropped
+        plain = u"".join([d for d in c if d < u"\x80" and d not in u"`~"])
+        self[code] = plain
+        return plain
+
+_plainify_table = PlainifyTable()
+_plainify_memo = {}
+
+
+def plainify_word(word):
+    """Returns word in lower case without accents and special characters"""
+    plain = _plainify_memo.get(word)
+    if plain is None:
+        plain = unicode(word.strip(PLAINIFY_STRIP)).translate(_plainify_table).encode('ascii').strip()
+        if len(_plainify_memo) >= PLAINIFY_MEMO_SIZE:
+            _plainify_memo.clear()
+        _plainify_memo[word] = plain
+    return plain
+
+
+def plainify(string):
+    """Removes all accents and special characters form string and converts
+    string to lower case. If the string is made up of several words a list
+    of these words is returned.
+
+    Returns an array of plainified strings (splitted at space)
+    """
+    res = []
+    for word in string.split(" "):
+        plain = plainify_word(word)
+        if plain:
+            res.append(plain)
+    return res
+
+def trigrams(token):
+    """Returns the set of trigrams of token. The token is padded with two
+    blanks in front and one at the end, so that its start weighs more."""
+    padded = "  %s " % (token)
+    return set([padded[i:i+3] for i in range(len(padded)-2)])
+
+
+def trigram_similarity(token1, token2):
+    """Returns the similarity of two tokens as the Dice coefficient of their
+    trigram sets (1.0 for equal tokens, 0.0 if nothing is shared)"""
+    grams1 = trigrams(token1)
+    grams2 = trigrams(token2)
+    if not grams1 or not grams2:
+        return 0.0
+    return 2.0 * len(grams1 & grams2) / (len(grams1) + len(grams2))
+
+
+def cologne_phonetic(token):
+    """Returns the Cologne phonetics code (Koelner Phonetik) of a plainified
+    token. Names which sound alike get the same code, e.g. Meier, Mayer
+    and Maier are all coded '67'. Characters other than a-z are ignored.
+    """
+    word = [c for c in token.lower() if 'a' <= c <= 'z']
+    codes = []
+    for i in range(len(word)):
+        c = word[i]
+        prev = word[i-1] if i > 0 else None
+        next = word[i+1] if i+1 < len(word) else None
+        if c in "aeijouy":
+            code = "0"
+        elif c == "h":
+            code = ""
+        elif c == "b":
+            code = "1"
+        elif c == "p":
+            code = "3" if next == "h" else "1"
+        elif c in "dt":
+            code = "8" if next in ("c","s","z") else "2"
+        elif c in "fvw":
+            code = "3"
+        elif c in "gkq":
+            code = "4"
+        elif c == "c":
+            if prev is None:
+                code = "4" if next in ("a","h","k","l","o","q","r","u","x") else "8"
+            elif prev in ("s","z"):
+                code = "8"
+            else:
+                code = "4" if next in ("a","h","k","o","q","u","x") else "8"
+        elif c == "x":
+            code = "8" if prev in ("c","k","q") else "48"
+        elif c == "l":
+            code = "5"
+        elif c in "mn":
+            code = "6"
+        elif c == "r":
+            code = "7"
+        else:
+            # s, z
+            code = "8"
+        codes.append(code)
+
+    # collapse repeated codes and drop vowels except at the beginning
+    res = ""
+    for code in "".join(codes):
+        if not res or res[-1] != code:
+            res = res + code
+    return res[:1] + res[1:].replace("0", "")
+
+
+def json_list_items(chunks):
+    """Splits a JSON list which is read piecewise (chunks is an iterable
+    of strings) into the texts of its elements. The elements are yielded
+    one by one, so that only one of them is held in memory.
+
+    Only the top level list is split, elements are not checked.
+    """
+    depth = 0
+    in_string = False
+    escape = False
+    item = []
+    for chunk in chunks:
+        start = 0
+        for i in range(len(chunk)):
+            c = chunk[i]
+            if in_string:
+                if escape:
+                    escape = False
+                elif c == '\\':
+                    escape = True
+                elif c == '"':
+                    in_string = False
+            elif c == '"':
+                in_string = True
+            elif c in '[{':
+                depth = depth + 1
+                if depth == 1:
+                    # the list starts, elements follow
+                    start = i + 1
+            elif c in ']}':
+                depth = depth - 1
+                if depth == 0:
+                    item.append(chunk[start:i])
+                    text = "".join(item).strip()
+                    if text:
+                        yield text
+                    item = []
+                    start = i + 1
+            elif c == ',' and depth == 1:
+                item.append(chunk[start:i])
+                yield "".join(item).strip()
+                item = []
+                start = i + 1
+        if depth > 0:
+            item.append(chunk[start:])
+
+
+def yaml_list_items(chunks):
+    """Splits a YAML block sequence which is read piecewise (chunks is an
+    iterable of strings) into the texts of its elements, one by one.
+
+    Every element is returned as a one element sequence. An element
+    starts with a line which begins with '-' in the first column.
+    """
+    item = []
+    rest = ""
+    for chunk in chunks:
+        lines = (rest + chunk).split("\n")
+        # the last line may continue in the next chunk
+        rest = lines.pop()
+        for line in lines:
+            if line.startswith("---") or line.startswith("#"):
+                continue
+            if (line == "-" or line.startswith("- ")) and item:
+                yield "\n".join(item) + "\n"
+                item = []
+            if item or line.startswith("-"):
+                item.append(line)
+    if rest:
+        item.append(rest)
+    if item:
+        yield "\n".join(item) + "\n"
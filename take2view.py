@@ -11,6 +11,7 @@ from google.appengine.ext import db
 from take2dbm import Contact, Person, Company, Take2, FuzzyDate
 from take2dbm import Email, Address, Mobile, Web, Other, Country, SharedTake2, GeoIndex
 from take2access import visible_contacts
+from take2index import current_generation
 
 class Take2Overview(object):
     def __init__(self,headertext,class_name):
@@ -123,7 +124,49 @@ class ContactView():
             self.address.append_take2(AddressView(obj))
 
 
-def encode_contact(contact, login_user, include_attic=False, include_privacy=False):
+def resolve_take2_references(objs):
+    """Reads the Country of Address and the OtherTag of Other objects
+    with one batch get and sets them in the objects, so that they are
+    not read one by one when they are used."""
+    refs = []
+    for obj in objs:
+        if obj.class_name() == "Address":
+            refs.append((obj,'country',Address.country.get_value_for_datastore(obj)))
+        elif obj.class_name() == "Other":
+            refs.append((obj,'tag',Other.tag.get_value_for_datastore(obj)))
+    keys = list(set([key for obj,name,key in refs if key]))
+    entities = dict(zip(keys,db.get(keys)))
+    for obj,name,key in refs:
+        if key and entities[key]:
+            setattr(obj, name, entities[key])
+
+
+def prefetch_take2(contacts, include_attic=False):
+    """Reads the take2 objects of a page of contacts at once
+
+    Returns a dictionary with the contact keys as keys and lists of
+    their take2 objects (newest first) as values. References are
+    resolved (see resolve_take2_references).
+    """
+    keys = [contact.key() for contact in contacts]
+    res = dict([(key,[]) for key in keys])
+    objs = []
+    # the datastore allows up to 30 values for IN
+    for n in range(0,len(keys),30):
+        q_obj = Take2.all()
+        q_obj.filter("contact_ref IN", keys[n:n+30])
+        if not include_attic:
+            q_obj.filter("attic =", False)
+        for obj in q_obj:
+            res[Take2.contact_ref.get_value_for_datastore(obj)].append(obj)
+            objs.append(obj)
+    for take2 in res.values():
+        take2.sort(key=lambda obj: obj.timestamp, reverse=True)
+    resolve_take2_references(objs)
+    return res
+
+
+def encode_contact(contact, login_user, include_attic=False, include_privacy=False, take2=None):
     """Factory to encode data into view classes which can easily be rendered
 
     The function takes into account the access rights and encodes only elements
@@ -132,6 +175,8 @@ def encode_contact(contact, login_user, include_attic=False, include_privacy=Fal
     If include_attic=True, data will include the complete history and also archived data.
     If include_privacy is set, it will include the privacy setting for contacts
     this user owns: private, restricted or public
+    take2 are the contact's take2 objects if they were already read
+    (see prefetch_take2).
     """
     result = None
     # do only enclose non-attic contacts unless attic parameter is set
@@ -187,16 +232,23 @@ def encode_contact(contact, login_user, include_attic=False, include_privacy=Fal
         #
         # encode contact's data
         #
-        q_obj = Take2.all()
-        q_obj.filter("contact_ref =", contact)
-        q_obj.order('-timestamp')
-        for obj in q_obj:
+        if take2 is None:
+            q_obj = Take2.all()
+            q_obj.filter("contact_ref =", contact)
+            q_obj.order('-timestamp')
+            take2 = q_obj.fetch(1000)
+            resolve_take2_references(take2)
+        if include_privacy:
+            # the entries in the SharedTake2 table by take2 object
+            shared = {}
+            for priv in SharedTake2.all().filter("contact_ref =", contact):
+                shared[SharedTake2.take2_ref.get_value_for_datastore(priv)] = priv
+        for obj in take2:
             # do only enclose non-attic take2 properties unless attic parameter is set
             if obj.attic and not include_attic:
                 continue
             if include_privacy:
-                # look for an entry in the SharedTake2 table
-                priv = SharedTake2.all().filter("contact_ref =", contact).filter("take2_ref =", obj).get()
+                priv = shared.get(obj.key())
                 if priv:
                     if priv.class_name() == "PublicTake2":
                         # add privacy property to obj on the fly
@@ -236,6 +288,7 @@ def geocode_contact(contact, login_user, include_attic=False, include_privacy=Fa
 
     # lookup coordinates for this point
     q_geo = GeoIndex.all()
+    q_geo.filter("generation =", current_generation())
     q_geo.filter("contact_ref =", contact)
     if not include_attic:
         q_geo.filter("attic =", False)
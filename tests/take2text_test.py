@@ -0,0 +1,57 @@
+#!/usr/bin/python2.5
+
+"""Unit tests for the import splitters in take2text.py."""
+
+import unittest
+
+from take2text import json_list_items, yaml_list_items
+
+
+def pieces(text, size):
+    """Returns text cut into chunks of size characters"""
+    return [text[n:n+size] for n in range(0,len(text),size)]
+
+
+class JsonListItemsTests(unittest.TestCase):
+    def test_split(self):
+        text = '[{"name": "Meier, Hans", "tags": ["a", "b"]}, {"name": "Say \\"hi]\\""}, 3]'
+        expected = ['{"name": "Meier, Hans", "tags": ["a", "b"]}',
+                    '{"name": "Say \\"hi]\\""}',
+                    '3']
+        # the result must not depend on where the chunks are cut
+        for size in range(1,len(text)+1):
+            self.assertEqual(expected, list(json_list_items(pieces(text, size))))
+
+    def test_empty(self):
+        self.assertEqual([], list(json_list_items(['[', ' ', ']'])))
+        self.assertEqual([], list(json_list_items([])))
+
+    def test_whitespace(self):
+        text = '[\n  {"a": 1},\n  {"b": 2}\n]\n'
+        self.assertEqual(['{"a": 1}', '{"b": 2}'], list(json_list_items(pieces(text, 4))))
+
+
+class YamlListItemsTests(unittest.TestCase):
+    def test_split(self):
+        text = ("---\n"
+                "# exported contacts\n"
+                "- name: Meier\n"
+                "  tags: [a, b]\n"
+                "- name: Mayer\n"
+                "  email:\n"
+                "  - a@example.com\n"
+                "-\n"
+                "  name: Maier")
+        expected = ["- name: Meier\n  tags: [a, b]\n",
+                    "- name: Mayer\n  email:\n  - a@example.com\n",
+                    "-\n  name: Maier\n"]
+        for size in range(1,len(text)+1):
+            self.assertEqual(expected, list(yaml_list_items(pieces(text, size))))
+
+    def test_empty(self):
+        self.assertEqual([], list(yaml_list_items(["--- []\n"])))
+        self.assertEqual([], list(yaml_list_items([])))
+
+
+if __name__ == '__main__':
+    unittest.main()